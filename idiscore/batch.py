@@ -0,0 +1,253 @@
+"""Deidentifying many datasets at once, spread out over multiple processes
+
+Examples
+--------
+>>> core = create_default_core()
+>>> for result in core.deidentify_many(paths, max_workers=8):
+>>>     if not result.succeeded:
+>>>         print(f"{result.source}: {result.status} {result.message}")
+"""
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Set, Tuple, Union
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+from idiscore.bouncers import DatasetRejected
+from idiscore.exceptions import IDISCoreError
+
+PathLike = Union[str, os.PathLike]
+
+# A dataset, a path to read from, or a path to read from and a path to write to
+BatchItem = Union[Dataset, PathLike, Tuple[PathLike, PathLike]]
+
+
+class BatchStatus:
+    """What happened to a single item in a batch?"""
+
+    SUCCESS = "SUCCESS"
+    REJECTED = "REJECTED"  # a bouncer did not allow this dataset
+    FAILED = "FAILED"  # deidentification or reading the item failed
+
+    ALL = {SUCCESS, REJECTED, FAILED}
+
+
+@dataclass(frozen=True)
+class BatchResult:
+    """The outcome of deidentifying a single item in a batch
+
+    Lightweight on purpose. Datasets written to disk by the worker are not sent
+    back, and rejection or failure is recorded as a message, not an exception
+    """
+
+    index: int  # position of the item in the input
+    status: str  # one of BatchStatus
+    source: Optional[str] = None  # path the dataset was read from, if any
+    destination: Optional[str] = None  # path the result was written to, if any
+    dataset: Optional[Dataset] = None  # deidentified, if not written to disk
+    message: str = ""  # reason for rejection or failure
+    size: int = 0  # size of the source file in bytes, if read from disk
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == BatchStatus.SUCCESS
+
+
+def process_item(deidentifier, index: int, item: BatchItem) -> BatchResult:
+    """Deidentify a single batch item and record the outcome
+
+    Parameters
+    ----------
+    deidentifier: Deidentifier
+        Use this to deidentify. Files are read with its read() method and
+        written with its write() method, if any
+    index: int
+        Position of this item in the batch
+    item: BatchItem
+        A Dataset, a path to a DICOM file, or a tuple (path in, path out). If
+        a path out is given the result is written there instead of returned.
+
+    Returns
+    -------
+    BatchResult
+        Success, rejection or failure. Rejection and failure are recorded, not
+        raised. This includes unexpected errors, like a ValueError for a value
+        that cannot be processed
+    """
+    source = destination = None
+    size = 0
+    try:
+        if isinstance(item, Dataset):
+            dataset = item
+        else:
+            if isinstance(item, tuple):
+                source, destination = (str(x) for x in item)
+            else:
+                source = str(item)
+            size = os.path.getsize(source)
+            dataset = getattr(deidentifier, "read", dcmread)(source)
+
+        deidentified = deidentifier.deidentify(dataset)
+
+        if destination:
+            Path(destination).parent.mkdir(parents=True, exist_ok=True)
+            write = getattr(deidentifier, "write", None)
+            if write:
+                write(deidentified, destination, source)
+            else:
+                deidentified.save_as(destination)
+            deidentified = None  # don't send back what has been written already
+
+    except Exception as e:  # a single item should never end the whole batch
+        message = error_message(e)
+        if not isinstance(e, (IDISCoreError, InvalidDicomError, OSError)):
+            message = f"{type(e).__name__}: {message}"  # unexpected, say what
+        return BatchResult(
+            index=index,
+            status=BatchStatus.REJECTED if was_rejected(e) else BatchStatus.FAILED,
+            source=source,
+            destination=destination,
+            message=message,
+            size=size,
+        )
+
+    return BatchResult(
+        index=index,
+        status=BatchStatus.SUCCESS,
+        source=source,
+        destination=destination,
+        dataset=deidentified,
+        size=size,
+    )
+
+
+def was_rejected(error: Optional[BaseException]) -> bool:
+    """True if error was caused by a bouncer rejecting a dataset"""
+    while error is not None:
+        if isinstance(error, DatasetRejected):
+            return True
+        error = error.__cause__
+    return False
+
+
+def error_message(error: Optional[BaseException]) -> str:
+    """The first non-empty message in error or the errors that caused it"""
+    while error is not None:
+        if message := str(error):
+            return message
+        error = error.__cause__
+    return ""
+
+
+# The deidentifier for the current worker process. Set once per process by
+# initialize_worker() so that caches stay warm between items
+_worker_deidentifier = None
+
+
+def initialize_worker(deidentifier_or_factory):
+    """Set the deidentifier for this worker process.
+
+    Parameters
+    ----------
+    deidentifier_or_factory: Deidentifier or Callable[[], Deidentifier]
+        Either a Deidentifier, or a function that creates one. Use a function when
+        the Deidentifier cannot be pickled, for example because it contains
+        lambda criteria
+    """
+    global _worker_deidentifier
+    if hasattr(deidentifier_or_factory, "deidentify"):
+        _worker_deidentifier = deidentifier_or_factory
+    else:
+        _worker_deidentifier = deidentifier_or_factory()
+
+
+def process_item_in_worker(index: int, item: BatchItem) -> BatchResult:
+    """Process item using the deidentifier of the current worker process"""
+    return process_item(_worker_deidentifier, index, item)
+
+
+def deidentify_many(
+    deidentifier_or_factory: Union[Any, Callable[[], Any]],
+    items: Iterable[BatchItem],
+    max_workers: Optional[int] = None,
+    ordered: bool = True,
+    max_pending: Optional[int] = None,
+) -> Iterator[BatchResult]:
+    """Deidentify items in parallel using a pool of worker processes
+
+    Each worker process holds its own deidentifier, created once, which is re-used
+    for all items that worker processes.
+
+    Parameters
+    ----------
+    deidentifier_or_factory: Deidentifier or Callable[[], Deidentifier]
+        Use this to deidentify. A Deidentifier is pickled and sent to each worker.
+        A function is called once in each worker to create a Deidentifier
+    items: Iterable[BatchItem]
+        Datasets, paths to DICOM files, or tuples (path in, path out). Consumed
+        lazily, so this can be a generator over millions of paths.
+    max_workers: int, optional
+        Number of worker processes. Defaults to the number of CPUs
+    ordered: bool, optional
+        If True, yield results in the same order as items. If False, yield each
+        result as soon as it is done. Defaults to True
+    max_pending: int, optional
+        Maximum number of items submitted but not yet yielded. Limits memory use
+        for large inputs. Defaults to 4 times the number of workers
+
+    Returns
+    -------
+    Iterator[BatchResult]
+        One result for each item
+
+    Notes
+    -----
+    Each worker has its own copy of the deidentifier. State is not shared between
+    workers. For example, the random date shift per study in Clean() will differ
+    between datasets of the same study that are processed by different workers
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or max_workers * 4
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=initialize_worker,
+        initargs=(deidentifier_or_factory,),
+    )
+    try:
+        if ordered:
+            yield from _yield_ordered(executor, items, max_pending)
+        else:
+            yield from _yield_unordered(executor, items, max_pending)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _yield_ordered(
+    executor: ProcessPoolExecutor, items: Iterable[BatchItem], max_pending: int
+) -> Iterator[BatchResult]:
+    pending: deque = deque()
+    for index, item in enumerate(items):
+        pending.append(executor.submit(process_item_in_worker, index, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _yield_unordered(
+    executor: ProcessPoolExecutor, items: Iterable[BatchItem], max_pending: int
+) -> Iterator[BatchResult]:
+    pending: Set[Future] = set()
+    for index, item in enumerate(items):
+        pending.add(executor.submit(process_item_in_worker, index, item))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from (x.result() for x in done)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from (x.result() for x in done)
@@ -1,7 +1,12 @@
+import re
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
-from typing import Union, List, Any, Dict
+from typing import Union, List, Any, Callable, Dict, Optional, Hashable, Set, Tuple
 
-from dicomcriterion import Criterion
+from dicomcriterion import Criterion, DicomSymbol
+from pydicom.datadict import tag_for_keyword
 from pydicom.dataset import Dataset
 from pydicom.uid import (
     ColorSoftcopyPresentationStateStorage,
@@ -11,12 +16,13 @@ from pydicom.uid import (
     KeyObjectSelectionDocumentStorage,
 )
 
-from idiscore.dataset import RequiredDataset, RequiredTagNotFound
+from idiscore.criteria import parse_criterion
+from idiscore.dataset import OverlayDataset, RequiredTagNotFound, RequiredView
 from idiscore.exceptions import IDISCoreError
 
 
 def handle_required_tag_not_found(func):
-    """Decorator for handling missing dataset keys, together with RequiredDataset()
+    """Decorator for handling missing dataset keys, together with RequiredView()
 
     Reduces duplicated code in most Bouncer.inspect() definitions
     """
@@ -35,9 +41,24 @@ def handle_required_tag_not_found(func):
 
 
 class Bouncer:
-    """Inspects a dataset and either rejects it or lets it through"""
+    """Inspects a dataset and either rejects it or lets it through
+
+    class parameters
+    ----------------
+    description: str
+        Single line description used in human-readable output
+    required_tags: List[str], optional
+        DICOM keywords of all elements that inspect() looks at. If given, datasets
+        can be inspected based on these elements alone, before reading the rest
+        of a file. Defaults to None, meaning unknown
+    series_level: bool
+        If True, inspect() gives the same answer for all datasets in a series.
+        Defaults to False
+    """
 
-    description = "Bouncer"  # single line description used in human-readable output
+    description = "Bouncer"
+    required_tags: Optional[List[str]] = None
+    series_level = False
 
     def inspect(self, dataset: Dataset) -> bool:
         """Raise DatasetRejected if given dataset is not allowed through
@@ -77,6 +98,7 @@ class Bouncer:
 class RejectNonStandardDicom(Bouncer):
 
     description = "Reject non-standard DICOM types by SOPClassUID"
+    required_tags = ["SOPClassUID"]
 
     @handle_required_tag_not_found
     def inspect(self, dataset: Dataset):
@@ -85,10 +107,11 @@ class RejectNonStandardDicom(Bouncer):
         All standard types are listed in DICOM PS3.4 section 5B:
         http://dicom.nema.org/dicom/2013/output/chtml/part04/sect_B.5.html
         """
+        view = RequiredView(dataset)
 
-        if not dataset.SOPClassUID.startswith("1.2.840.10008"):
+        if not view.SOPClassUID.startswith("1.2.840.10008"):
             raise DatasetRejected(
-                f'This dataset has SOPClassUID "{dataset.SOPClassUID}", which is '
+                f'This dataset has SOPClassUID "{view.SOPClassUID}", which is '
                 f"non-standard. Deidentification would be too risky"
             )
 
@@ -96,6 +119,7 @@ class RejectNonStandardDicom(Bouncer):
 class RejectKOGSPS(Bouncer):
 
     description = "Reject PresentationStorage and KeyObjectSelectionDocument"
+    required_tags = ["SOPClassUID", "SeriesDescription"]
 
     @handle_required_tag_not_found
     def inspect(self, dataset: Dataset):
@@ -112,37 +136,37 @@ class RejectKOGSPS(Bouncer):
             When the dataset is one of these types
 
         """
-        dataset = RequiredDataset(dataset)  # allows catching missing keys
+        view = RequiredView(dataset)  # allows catching missing keys
 
-        if dataset.SOPClassUID == KeyObjectSelectionDocumentStorage:
+        if view.SOPClassUID == KeyObjectSelectionDocumentStorage:
             raise DatasetRejected(
-                f"SOPClass {dataset.SOPClassUID} often contains physician"
-                f" information"
+                f"SOPClass {view.SOPClassUID} often contains physician" f" information"
             )
-        elif dataset.SOPClassUID in [
+        elif view.SOPClassUID in [
             ColorSoftcopyPresentationStateStorage,
             GrayscaleSoftcopyPresentationStateStorage,
         ]:
-            if dataset.SeriesDescription != "Annotation":
+            if view.SeriesDescription != "Annotation":
                 raise DatasetRejected(
-                    f'SOPClass "{dataset.SOPClassUID}" is only safe for '
+                    f'SOPClass "{view.SOPClassUID}" is only safe for '
                     f"annotations, but this series is described as"
-                    f' "{dataset.SeriesDescription}"'
+                    f' "{view.SeriesDescription}"'
                 )
 
 
 class RejectEncapsulatedImageStorage(Bouncer):
 
     description = "Reject encapsulated PDF and CDA"
+    required_tags = ["SOPClassUID"]
 
     @handle_required_tag_not_found
     def inspect(self, dataset: Dataset):
-        dataset = RequiredDataset(dataset)
+        view = RequiredView(dataset)
 
-        if dataset.SOPClassUID in [EncapsulatedPDFStorage, EncapsulatedCDAStorage]:
+        if view.SOPClassUID in [EncapsulatedPDFStorage, EncapsulatedCDAStorage]:
             raise DatasetRejected(
                 f"This dataset has is for encapsulated image data (SOPClassUID "
-                f'"{dataset.SOPClassUID}"), which often contains patient'
+                f'"{view.SOPClassUID}"), which often contains patient'
                 f"information. Too risky"
             )
 
@@ -156,7 +180,12 @@ class CriterionBouncer(Bouncer):
 
     """
 
-    def __init__(self, criterion: Union[Criterion, str], justification: str = ""):
+    def __init__(
+        self,
+        criterion: Union[Criterion, str],
+        justification: str = "",
+        required_tags: Optional[List[str]] = None,
+    ):
         """
 
         Parameters
@@ -166,6 +195,9 @@ class CriterionBouncer(Bouncer):
         justification: str, optional
             Human-readable reason for this bouncer. Why should matching data be
             rejected? Defaults to empty string
+        required_tags: List[str], optional
+            DICOM keywords of all elements that criterion looks at. See
+            Bouncer.required_tags. Defaults to None, meaning unknown
 
         Raises
         ------
@@ -173,21 +205,460 @@ class CriterionBouncer(Bouncer):
             If criterion string input could not be parsed
 
         """
+        self.expression: Optional[str] = None
         if isinstance(criterion, str):  # cast from str for convenience
-            criterion = Criterion(criterion)
+            self.expression = criterion.strip()
+            criterion = parse_criterion(self.expression)
         self.criterion = criterion
         self.justification = justification
+        self.required_tags = required_tags
 
     def inspect(self, dataset):
         matched = self.criterion.evaluate(dataset)
         if matched:
-            raise DatasetRejected(
-                f"Rejected by bouncer. Dataset matched {self.criterion}."
-                f" Justification: {self.justification}"
-            )
+            self.reject()
+
+    def reject(self):
+        """Raise the DatasetRejected that inspect() raises when criterion matches"""
+        raise DatasetRejected(
+            f"Rejected by bouncer. Dataset matched {self.criterion}."
+            f" Justification: {self.justification}"
+        )
+
+
+# a single dicomcriterion symbol like "Modality.equals('CT')", quotes and all
+SYMBOL_PATTERN = (
+    r"[a-zA-Z_][a-zA-Z0-9_]*\.[a-zA-Z_][a-zA-Z0-9_]*\("
+    r"(?:[^'\"()]|'[^']*'|\"[^\"]*\")*"
+    r"\)"
+)
+EQUALS_CHAIN = re.compile(rf"\s*{SYMBOL_PATTERN}(?:\s+or\s+{SYMBOL_PATTERN})*\s*")
+
+
+def equals_arguments(expression: str) -> Optional[List[Tuple[str, str]]]:
+    """(keyword, argument) for each part of a chain of equals() symbols
+    like "Modality.equals('CT') or Modality.equals('MR')"
+
+    Returns
+    -------
+    List[Tuple[str, str]] or None
+        None if expression is anything else, or if any attribute is not a DICOM
+        keyword
+    """
+    if not EQUALS_CHAIN.fullmatch(expression):
+        return None
+    symbols = [DicomSymbol.parse(x) for x in re.findall(SYMBOL_PATTERN, expression)]
+    if any(
+        x.function != "equals"
+        or x.argument is None
+        or tag_for_keyword(x.attribute) is None
+        for x in symbols
+    ):
+        return None
+    return [(x.attribute, x.argument) for x in symbols]
+
+
+def equals_key(value) -> Optional[str]:
+    """What dicomcriterion's equals() compares for this element value
+
+    Comparison is case-insensitive and ignores surrounding whitespace. None
+    stands for a value of None, which equals "none", "null" and ""
+    """
+    if value is None:
+        return None
+    if hasattr(value, "value"):
+        value = value.value
+    return str(value).strip().lower()
+
+
+class CriterionTable(Bouncer):
+    """Decides many CriterionBouncers like "Modality.equals('US')" in one go
+
+    Every value that any of the bouncers rejects is put in a table per keyword.
+    Inspecting a dataset is then a single lookup per keyword, however many
+    bouncers there are. Gives the same answers as inspecting with each bouncer
+    in turn, with the same rejection message.
+
+    Only bouncers created from an expression of equals() symbols joined by 'or'
+    can be put in a table. See compile_bouncers()
+    """
+
+    _missing = object()
+
+    def __init__(self, bouncers: List[CriterionBouncer]):
+        """
+
+        Parameters
+        ----------
+        bouncers: List[CriterionBouncer]
+            Decide for all these bouncers
+
+        Raises
+        ------
+        ValueError
+            If any bouncer cannot be put in a table
+        """
+        self.bouncers = bouncers
+        self.description = f"Table of {len(bouncers)} criterion bouncers"
+        # keyword -> equals_key -> positions of rejecting bouncers
+        self._table: Dict[str, Dict[Optional[str], List[int]]] = {}
+        for position, bouncer in enumerate(bouncers):
+            arguments = equals_arguments(bouncer.expression or "")
+            if arguments is None:
+                raise ValueError(f"Cannot put {bouncer.criterion} in a table")
+            for keyword, argument in arguments:
+                values = self._table.setdefault(keyword, {})
+                keys: Set[Optional[str]] = {argument.strip().lower()}
+                if argument.lower() in ("none", "null", ""):
+                    keys.add(None)
+                for key in keys:
+                    values.setdefault(key, []).append(position)
+        self.required_tags = sorted(self._table)
+
+    def inspect(self, dataset: Dataset):
+        rejecting: List[int] = []
+        try:
+            for keyword, values in self._table.items():
+                value = dataset.get(keyword, self._missing)
+                if value is not self._missing:
+                    rejecting.extend(values.get(equals_key(value), ()))
+        except Exception:  # leave reporting this to the interpreter
+            for bouncer in self.bouncers:
+                bouncer.inspect(dataset)
+            return
+        if rejecting:
+            self.bouncers[min(rejecting)].reject()  # first in list, like interpreted
+
+
+def compile_bouncers(bouncers: List[Bouncer]) -> List[Bouncer]:
+    """Bouncers, with all simple CriterionBouncers replaced by one CriterionTable
+
+    The table takes the place of the first bouncer it replaces. All other bouncers
+    are kept as they are and still evaluated one by one. Datasets are rejected
+    or let through just the same. If more than one bouncer would reject a dataset,
+    the rejection that is reported might be a different one.
+
+    Example
+    -------
+    >>> Core(profile, bouncers=compile_bouncers(bouncers))
+    """
+    simple = [
+        x
+        for x in bouncers
+        if isinstance(x, CriterionBouncer) and equals_arguments(x.expression or "")
+    ]
+    if len(simple) < 2:
+        return list(bouncers)
+
+    replaced = {id(x) for x in simple}
+    compiled: List[Bouncer] = []
+    for bouncer in bouncers:
+        if bouncer is simple[0]:
+            compiled.append(CriterionTable(simple))
+        elif id(bouncer) not in replaced:
+            compiled.append(bouncer)
+    return compiled
+
+
+class BouncerDecisionCache:
+    """Remembers the decision of each bouncer for the values it inspects
+
+    Datasets in the same series tend to have the same values for the elements
+    that bouncers look at. Decisions of bouncers that declare required_tags are
+    keyed on the values of these elements. Decisions of series_level bouncers
+    are keyed on SeriesInstanceUID, and on BurnedInAnnotation if they might depend
+    on it. Other bouncers are always run.
+
+    Rejections and bouncer errors are remembered too, and raised again with the
+    same message. Least recently used decisions are discarded when max_size is
+    exceeded. Safe to use from multiple threads
+    """
+
+    # signals 'no decision yet' or 'element not in dataset'. None means 'accepted'
+    _missing = object()
+
+    def __init__(self, max_size: int = 4096):
+        """
+
+        Parameters
+        ----------
+        max_size: int, optional
+            Maximum number of decisions to keep. Defaults to 4096
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._decisions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
 
+    def __len__(self):
+        return len(self._decisions)
 
-def determine_bouncer_results(bouncers: List[Bouncer], dataset: Dataset):
+    def __getstate__(self):
+        """Decisions and lock are not pickled. Decisions hold on to bouncers"""
+        state = self.__dict__.copy()
+        state["_decisions"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def inspect(self, bouncer: Bouncer, dataset: Dataset):
+        """bouncer.inspect(dataset), or its remembered outcome
+
+        Raises
+        ------
+        DatasetRejected
+            When bouncer rejects dataset, or rejected the same values before
+        BouncerError
+            When bouncer cannot determine its answer, now or before
+        """
+        key = self.key(bouncer, dataset)
+        if key is None:
+            bouncer.inspect(dataset)
+            return
+
+        with self._lock:
+            decision = self._decisions.get(key, self._missing)
+            if decision is self._missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._decisions.move_to_end(key)
+
+        if decision is self._missing:
+            try:
+                bouncer.inspect(dataset)
+                decision = None
+            except (DatasetRejected, BouncerError) as e:
+                self.store(key, (type(e), e.args))
+                raise
+            self.store(key, decision)
+        elif decision is not None:
+            error_class, args = decision
+            raise error_class(*args)
+
+    def store(self, key: Hashable, decision):
+        with self._lock:
+            self._decisions[key] = decision
+            if len(self._decisions) > self.max_size:
+                self._decisions.popitem(last=False)
+
+    @classmethod
+    def key(cls, bouncer: Bouncer, dataset: Dataset) -> Optional[Hashable]:
+        """Key under which to remember the decision of bouncer for dataset
+
+        Returns
+        -------
+        Hashable or None
+            None if the decision cannot be remembered. For example if bouncer does
+            not declare its required tags, or if any of their values is a sequence
+        """
+        if bouncer.series_level:
+            series_uid = dataset.get("SeriesInstanceUID")
+            if not series_uid:
+                return None
+            if depends_on_burned_in_annotation(bouncer):
+                # the same series is inspected before and after pixel cleaning
+                return bouncer, series_uid, dataset.get("BurnedInAnnotation")
+            return bouncer, series_uid
+        if bouncer.required_tags is None:
+            return None
+
+        values = []
+        for keyword in bouncer.required_tags:
+            value = dataset.get(keyword, cls._missing)
+            if isinstance(value, list):  # MultiValue or Sequence
+                value = tuple(value)
+            try:
+                hash(value)
+            except TypeError:
+                return None
+            values.append(value)
+        return bouncer, tuple(values)
+
+    def clear(self):
+        """Remove all decisions and reset counters"""
+        with self._lock:
+            self._decisions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Number of hits, misses and decisions currently cached"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+def run_bouncer(
+    bouncer: Bouncer, dataset: Dataset, cache: Optional[BouncerDecisionCache] = None
+):
+    """bouncer.inspect(dataset), through cache if given"""
+    if cache is None:
+        bouncer.inspect(dataset)
+    else:
+        cache.inspect(bouncer, dataset)
+
+
+class AdaptiveBouncerOrder:
+    """Runs bouncers with the most likely and cheapest rejections first
+
+    Records the evaluation time and rejection rate of each bouncer. Bouncers are
+    run in order of rejection rate per second of evaluation time, highest first.
+    Bouncers not seen before go first, to find out.
+
+    The outcome does not depend on the order. If several bouncers would reject a
+    dataset, the rejection of the one that comes first in the given list is
+    raised, as if running them in list order.
+    """
+
+    def __init__(self):
+        # bouncer -> [evaluations, rejections, total seconds]
+        self._stats: Dict[Bouncer, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """Statistics and lock are not pickled. Statistics hold on to bouncers"""
+        state = self.__dict__.copy()
+        state["_stats"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def score(self, bouncer: Bouncer) -> float:
+        """Rejections per second of evaluation. Higher should go first"""
+        evaluations, rejections, seconds = self._stats.get(bouncer, (0, 0, 0.0))
+        if not evaluations or not seconds:
+            return float("inf")
+        rate = (rejections + 1) / (evaluations + 2)  # not 0 for rare rejections
+        return rate / (seconds / evaluations)
+
+    def order(self, bouncers: List[Bouncer]) -> List[int]:
+        """Positions of bouncers in the order they should be run"""
+        return sorted(range(len(bouncers)), key=lambda x: -self.score(bouncers[x]))
+
+    def run(self, bouncers: List[Bouncer], inspect: Callable[[Bouncer], None]):
+        """Call inspect(bouncer) for each bouncer, in adaptive order
+
+        Raises
+        ------
+        DatasetRejected or BouncerError
+            The error inspect() raises for the first bouncer in bouncers that
+            raises one
+        """
+        done = set()
+        for position in self.order(bouncers):
+            try:
+                self.measure(bouncers[position], inspect)
+            except (DatasetRejected, BouncerError):
+                # Bouncers earlier in the list might reject as well. Theirs counts
+                for earlier in range(position):
+                    if earlier not in done:
+                        self.measure(bouncers[earlier], inspect)
+                raise
+            done.add(position)
+
+    def measure(self, bouncer: Bouncer, inspect: Callable[[Bouncer], None]):
+        """Call inspect(bouncer) and record time taken and outcome"""
+        rejected = False
+        start = time.perf_counter()
+        try:
+            inspect(bouncer)
+        except (DatasetRejected, BouncerError):
+            rejected = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats.setdefault(bouncer, [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += rejected
+                stats[2] += seconds
+
+    def stats(self) -> Dict[Bouncer, Dict[str, float]]:
+        """Evaluations, rejection rate and mean seconds for each bouncer"""
+        with self._lock:
+            return {
+                bouncer: {
+                    "evaluations": evaluations,
+                    "rejection_rate": rejections / evaluations,
+                    "mean_seconds": seconds / evaluations,
+                }
+                for bouncer, (evaluations, rejections, seconds) in self._stats.items()
+            }
+
+
+def run_bouncers(
+    bouncers: List[Bouncer],
+    inspect: Callable[[Bouncer], None],
+    order: Optional[AdaptiveBouncerOrder] = None,
+):
+    """Call inspect(bouncer) for each bouncer, in list order or in order if given"""
+    if order is None:
+        for bouncer in bouncers:
+            inspect(bouncer)
+    else:
+        order.run(bouncers, inspect)
+
+
+def inspect_best_case(
+    bouncers: List[Bouncer],
+    dataset: Dataset,
+    cache: Optional[BouncerDecisionCache] = None,
+    order: Optional[AdaptiveBouncerOrder] = None,
+):
+    """Run dataset through all bouncers as if clean_pixels has succeeded in cleaning
+
+    Bouncers that might depend on BurnedInAnnotation see it as "NO" through a view
+    of dataset. Dataset itself is not changed. Decisions are taken from cache if
+    given. Bouncers are run in order if given.
+
+    Raises
+    ------
+    DatasetRejected
+        If any bouncer rejects this dataset even with burned in pixel data removed
+    BouncerError
+        If any bouncer cannot determine its answer
+    """
+    best_case = None
+
+    def inspect(bouncer: Bouncer):
+        nonlocal best_case
+        if depends_on_burned_in_annotation(bouncer):
+            if best_case is None:
+                best_case = OverlayDataset(dataset, {"BurnedInAnnotation": "NO"})
+            run_bouncer(bouncer, best_case, cache)
+        else:
+            run_bouncer(bouncer, dataset, cache)  # same answer with or without clean
+
+    run_bouncers(bouncers, inspect, order)
+
+
+def depends_on_burned_in_annotation(bouncer: Bouncer) -> bool:
+    """True if bouncer might answer differently once pixel data has been cleaned
+
+    Bouncers that do not declare required_tags might
+    """
+    return (
+        bouncer.required_tags is None or "BurnedInAnnotation" in bouncer.required_tags
+    )
+
+
+def header_bouncers(bouncers: List[Bouncer]) -> List[Bouncer]:
+    """All bouncers that declare which elements they inspect"""
+    return [x for x in bouncers if x.required_tags is not None]
+
+
+def determine_bouncer_results(
+    bouncers: List[Bouncer],
+    dataset: Dataset,
+    cache: Optional[BouncerDecisionCache] = None,
+    order: Optional[AdaptiveBouncerOrder] = None,
+):
     """Run dataset through all bouncers. Extract bouncers that require pixel cleaning.
 
     This function determines two things:
@@ -196,6 +667,10 @@ def determine_bouncer_results(bouncers: List[Bouncer], dataset: Dataset):
            only needed if the result of clean_pixel potentially changes the bouncer
            results. The function returns those 'maybe allow' bouncers
 
+    Only bouncers that might depend on BurnedInAnnotation are run twice, see
+    depends_on_burned_in_annotation(). Dataset is not changed. Decisions are taken
+    from cache if given. Bouncers are run in order if given.
+
     Raises
     ------
     DatasetRejected
@@ -205,17 +680,14 @@ def determine_bouncer_results(bouncers: List[Bouncer], dataset: Dataset):
         If any bouncer cannot determine its answer
 
     """
-    # start with the most positive situation: clean_pixels has succeeded in cleaning
-    with PatchedDataset(dataset=dataset, patch={"BurnedInAnnotation": "NO"}) as patched:
-        for bouncer in bouncers:
-            # if any bouncer raises exceptions here then there is nothing to do. Reject.
-            bouncer.inspect(patched)
+    # if any bouncer raises exceptions here then there is nothing to do. Reject.
+    inspect_best_case(bouncers, dataset, cache, order)
 
     # No exceptions raised so far. All bouncers are either OK or Maybe OK.
     maybe_allow = []
-    for bouncer in bouncers:
+    for bouncer in filter(depends_on_burned_in_annotation, bouncers):
         try:
-            bouncer.inspect(dataset)
+            run_bouncer(bouncer, dataset, cache)
         except DatasetRejected:
             # This was OK with BurnedInAnnotation=No, and is not OK now.
             # So running clean_pixels and checking these bouncers again might work
@@ -4,9 +4,15 @@ Examples
 --------
 idiscore convert to_example <dcm file in>
 idiscore convert to_dicom <json file in>
+idiscore deidentify <folder in> <folder out> --workers 8
 """
+import importlib
+import importlib.util
 import logging
+import time
+from collections import Counter
 from pathlib import Path
+from typing import Iterator, Tuple
 
 import click
 from dicomgenerator.export import export
@@ -19,6 +25,8 @@ from idiscore.annotation import (
     annotate,
     create_default_scrambler,
 )
+from idiscore.batch import BatchStatus, deidentify_many
+from idiscore.core import Core
 from idiscore.defaults import get_dicom_rule_sets
 from idiscore.logs import get_module_logger
 
@@ -95,6 +103,126 @@ def to_dicom(json_file, output_file):
     export(example.dataset, path=output_file)
 
 
+class CoreFactory:
+    """Creates a Core from a definition string like 'module:attribute'
+
+    Module can be an importable module name like 'idiscore.defaults' or a path to
+    a python file like 'my_profiles/production.py'. Attribute should be either a
+    Core instance or a function without arguments that returns one.
+
+    Only holds the definition string, so it can be sent to worker processes
+    cheaply. Each worker creates its own Core.
+    """
+
+    def __init__(self, definition: str):
+        module_name, _, attribute = definition.rpartition(":")
+        if not module_name or not attribute.isidentifier():
+            raise ValueError(
+                f'Could not parse "{definition}". Expected format is '
+                f'"module:attribute" or "path/to/file.py:attribute"'
+            )
+        self.definition = definition
+        self.module_name = module_name
+        self.attribute = attribute
+
+    def __call__(self) -> Core:
+        if self.module_name.endswith(".py"):
+            spec = importlib.util.spec_from_file_location(
+                Path(self.module_name).stem, self.module_name
+            )
+            if spec is None or spec.loader is None:
+                raise ValueError(f'Could not load "{self.module_name}"')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(self.module_name)
+
+        core = getattr(module, self.attribute)
+        if callable(core) and not isinstance(core, Core):
+            core = core()
+        if not isinstance(core, Core):
+            raise ValueError(f'"{self.definition}" did not yield a Core instance')
+        return core
+
+
+def find_jobs(input_path: Path, output_path: Path) -> Iterator[Tuple[Path, Path]]:
+    """(input file, output file) for each file in input_path, recursively
+
+    Output files are placed at the same path relative to output_path as input
+    files are to input_path. If input_path is a file, output_path is used as is.
+    """
+    if input_path.is_file():
+        yield input_path, output_path
+        return
+    for path in sorted(input_path.rglob("*")):
+        if path.is_file():
+            yield path, output_path / path.relative_to(input_path)
+
+
+@click.command()
+@click.argument("input_path", type=click.Path(exists=True, path_type=Path))
+@click.argument("output_path", type=click.Path(path_type=Path))
+@click.option(
+    "--core",
+    "core_definition",
+    default="idiscore.defaults:create_default_core",
+    show_default=True,
+    help="Core to use, as 'module:attribute' or 'path/to/file.py:attribute'. "
+    "Attribute can be a Core or a function returning a Core",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of worker processes. Defaults to number of CPUs",
+)
+def deidentify(input_path, output_path, core_definition, workers):
+    """Deidentify all DICOM files in INPUT_PATH, write results to OUTPUT_PATH
+
+    Directory structure of INPUT_PATH is recreated in OUTPUT_PATH.
+    Files that are rejected or cannot be processed are not written. Exits with
+    status 1 if any file could not be processed
+    """
+    factory = CoreFactory(core_definition)
+    factory()  # fail early if core cannot be created
+
+    logger.info(
+        f"Deidentifying {input_path} into {output_path} using {factory.definition}"
+    )
+    counts: Counter = Counter()
+    total_bytes = 0
+    start = time.perf_counter()
+    for result in deidentify_many(
+        factory,
+        find_jobs(input_path, output_path),
+        max_workers=workers,
+        ordered=False,
+    ):
+        counts[result.status] += 1
+        total_bytes += result.size
+        if result.status == BatchStatus.REJECTED:
+            logger.warning(f"{result.status}: {result.source}: {result.message}")
+        elif result.status == BatchStatus.FAILED:
+            logger.error(f"{result.status}: {result.source}: {result.message}")
+    elapsed = max(time.perf_counter() - start, 1e-6)
+
+    processed = sum(counts.values())
+    click.echo(
+        f"Processed {processed} files in {elapsed:.1f}s "
+        f"({processed / elapsed:.1f} files/s, "
+        f"{total_bytes / 1e6 / elapsed:.1f} MB/s)"
+    )
+    click.echo(
+        f"{counts[BatchStatus.SUCCESS]} deidentified, "
+        f"{counts[BatchStatus.REJECTED]} rejected, "
+        f"{counts[BatchStatus.FAILED]} failed"
+    )
+    if counts[BatchStatus.FAILED]:
+        click.get_current_context().exit(1)
+
+
 main.add_command(convert)
+main.add_command(deidentify)
 convert.add_command(to_example)
 convert.add_command(to_dicom)
@@ -1,26 +1,42 @@
 import warnings
-from typing import List, Optional, Union, Iterable, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Union, Iterable, Tuple
 
 from dicomgenerator.dicom import VRs
-from pydicom.dataelem import DataElement
+from pydicom import dcmread
+from pydicom.dataelem import DataElement, RawDataElement
 from pydicom.dataset import Dataset
-from pydicom.sequence import Sequence
+from pydicom.hooks import hooks
 
 from idiscore import __version__
+from idiscore.batch import BatchItem, BatchResult, PathLike, deidentify_many
 from idiscore.bouncers import (
+    AdaptiveBouncerOrder,
     Bouncer,
+    BouncerDecisionCache,
     DatasetRejected,
     BouncerError,
     determine_bouncer_results,
+    header_bouncers,
+    inspect_best_case,
+    run_bouncer,
+    run_bouncers,
 )
 from idiscore.dataset import RequiredTagNotFound
 from idiscore.exceptions import IDISCoreError
+from idiscore.file_io import PruningReader, read_header, save_as
 from idiscore.image_processing import (
     PixelDataProcessorException,
     PixelProcessor,
 )
-from idiscore.operators import ElementShouldBeRemoved
-from idiscore.rules import RuleSet
+from idiscore.operators import (
+    REMOVE,
+    ElementShouldBeRemoved,
+    Empty,
+    Remove,
+    RemoveElement,
+)
+from idiscore.private_processing import PrivateBlockIndex
+from idiscore.rules import Rule, RulePlanCache, RuleSet, RuleSetOverlay
 from idiscore.templates import (
     idiscore_description_rst,
     idiscore_description_txt,
@@ -30,7 +46,7 @@ from idiscore.templates import (
 )
 
 # Used for holding a change to a DataElement (change or remove)
-Mutation = Union[DataElement, ElementShouldBeRemoved]
+Mutation = Union[DataElement, RemoveElement]
 
 
 class Profile:
@@ -46,6 +62,9 @@ class Profile:
     * A profile's RuleSets can be 'flattened' to have exactly one operation for
       each tag
 
+    * The flattened result is cached by compile(). Changing rule_sets, or removing
+      a rule from any of the rule sets, invalidates the cache
+
     """
 
     def __init__(self, rule_sets: List[RuleSet], name: str = "Profile"):
@@ -62,6 +81,10 @@ class Profile:
         """
         self.rule_sets = rule_sets
         self.name = name
+        self._compiled: Optional[RuleSet] = None
+        self._compiled_key: Optional[Tuple] = None
+        self._overlay: Optional[RuleSetOverlay] = None
+        self._overlay_key: Optional[Tuple] = None
 
     def __str__(self):
         return f'Profile "{self.name}"'
@@ -87,6 +110,42 @@ class Profile:
 
         return RuleSet(name="flattened", rules=set(output.values()))
 
+    def compile(
+        self, additional_rule_sets: Optional[List[RuleSet]] = None
+    ) -> Union[RuleSet, RuleSetOverlay]:
+        """Flattened rule set, built once and re-used until rule_sets change
+
+        Use this instead of flatten() when processing many datasets with the same
+        profile. The returned object is shared between calls. Do not modify it.
+
+        Parameters
+        ----------
+        additional_rule_sets: List[RuleSet]
+            Overrule the cached rules with these. Applied as a light-weight overlay
+            on top of the cached rules instead of re-flattening everything. The
+            overlay is cached as well, until any of these rule sets change
+
+        """
+        key = tuple((x, x.revision) for x in self.rule_sets)
+        if self._compiled is None or key != self._compiled_key:
+            self._compiled = self.flatten()
+            self._compiled_key = key
+
+        if not additional_rule_sets:
+            return self._compiled
+
+        overlay_key = (key, tuple((x, x.revision) for x in additional_rule_sets))
+        if self._overlay is None or overlay_key != self._overlay_key:
+            overlay = {}
+            for rule_set in additional_rule_sets:
+                overlay.update({x.identifier: x for x in rule_set.rules})
+            self._overlay = RuleSetOverlay(
+                base=self._compiled,
+                overlay=RuleSet(name="additional", rules=set(overlay.values())),
+            )
+            self._overlay_key = overlay_key
+        return self._overlay
+
     def description(self, text_format: str = "txt") -> str:
         """A multi-line, human-readable description of this profile
 
@@ -120,12 +179,64 @@ class Profile:
         )
 
 
+def raw_vr_or_none(element: RawDataElement, dataset: Dataset) -> Optional[str]:
+    """VR that raw element will have once converted, or None if this cannot be
+    known without converting the element
+
+    Uses the same lookup as pydicom, including the private dictionary for private
+    elements read with implicit VR. Does not read deferred values.
+    """
+    if element.length == 0xFFFFFFFF:  # undefined length
+        return None  # could be a sequence
+    data: Dict[str, Any] = {}
+    try:
+        hooks.raw_element_vr(element, data, ds=dataset)
+    except KeyError:
+        return None
+    return data["VR"]
+
+
+def convert_without_value(element: RawDataElement, dataset: Dataset) -> DataElement:
+    """Convert raw element in dataset to a DataElement with an empty value
+
+    For operators that replace the value anyway. Deferred values are not read
+    """
+    dataset[element.tag] = element._replace(value=b"", length=0)
+    return dataset[element.tag]
+
+
 class Deidentifier:
     """Something that has a deidentify() method that processes pydicom datasets"""
 
     def deidentify(self, dataset: Dataset) -> Dataset:
         raise NotImplementedError()
 
+    def read(self, path: PathLike) -> Dataset:
+        """Read DICOM file at path, for passing to deidentify()
+
+        Raises
+        ------
+        InvalidDicomError
+            If path is not a valid DICOM file
+        """
+        return dcmread(path)
+
+    def write(
+        self, dataset: Dataset, path: PathLike, source: Optional[PathLike] = None
+    ):
+        """Write deidentified dataset to path as a DICOM file
+
+        Parameters
+        ----------
+        dataset: Dataset
+            Output of deidentify()
+        path: PathLike
+            Write to this path
+        source: PathLike, optional
+            The file that dataset was read from, if any
+        """
+        dataset.save_as(path)
+
 
 class Core(Deidentifier):
     """Can deidentify a DICOM dataset. Holds all configuration, filters and
@@ -138,6 +249,10 @@ class Core(Deidentifier):
         insertions: Optional[List[DataElement]] = None,
         bouncers: Optional[List[Bouncer]] = None,
         pixel_processor: Optional[PixelProcessor] = None,
+        plan_cache: Optional[RulePlanCache] = None,
+        reader: Optional[PruningReader] = None,
+        bouncer_cache: Optional[BouncerDecisionCache] = None,
+        bouncer_order: Optional[AdaptiveBouncerOrder] = None,
     ):
         """
 
@@ -154,12 +269,98 @@ class Core(Deidentifier):
         pixel_processor: Optional[PrivateProcessor],
             Defines what to do with DICOM image data (the PixelData tag). Can remove
             or black out certain parts of an image. Defaults to None
+        plan_cache: Optional[RulePlanCache]
+            Remembers which rule applies to which element for datasets with the
+            same tags, so that rules are not looked up again for each dataset in
+            a series. Defaults to a new RulePlanCache with default size
+        reader: Optional[PruningReader]
+            Used by read(). Drops elements that profile removes anyway while
+            reading. Defaults to a new PruningReader with default settings
+        bouncer_cache: Optional[BouncerDecisionCache]
+            Remembers bouncer decisions for datasets with the same values for the
+            elements bouncers inspect, like the datasets in a series. Defaults to
+            a new BouncerDecisionCache with default size
+        bouncer_order: Optional[AdaptiveBouncerOrder]
+            If given, bouncers are run with the most likely and cheapest rejections
+            first. The rejection reported stays the same. Defaults to None,
+            meaning bouncers are run in list order
 
         """
         self.profile = profile
         self.insertions = insertions if insertions else []  # convert default None
         self.bouncers = bouncers if bouncers else []
         self.pixel_processor = pixel_processor
+        self.plan_cache = plan_cache if plan_cache is not None else RulePlanCache()
+        self.reader = reader if reader is not None else PruningReader()
+        self.bouncer_cache = (
+            bouncer_cache if bouncer_cache is not None else BouncerDecisionCache()
+        )
+        self.bouncer_order = bouncer_order
+
+    def read(self, path: PathLike) -> Dataset:
+        """Read DICOM file at path, for passing to deidentify()
+
+        Bouncers that declare their required tags inspect these first, read on
+        their own. Files they reject are not read any further. Private and
+        repeating group elements that the profile removes in all cases are dropped
+        before they are decoded.
+
+        Raises
+        ------
+        InvalidDicomError
+            If path is not a valid DICOM file
+        DeidentificationError
+            If a bouncer rejects the file based on its header
+        """
+        self.prescreen(path)
+        return self.reader.read(path, rules=self.profile.compile())
+
+    def prescreen(self, path: PathLike):
+        """Reject file at path if bouncers reject it based on its header alone
+
+        Only elements that bouncers declare in required_tags are read. Only
+        outright rejection counts here, as for the first check in
+        determine_bouncer_results(). Anything else is left for deidentify()
+
+        Raises
+        ------
+        InvalidDicomError
+            If path is not a valid DICOM file
+        DeidentificationError
+            If any bouncer rejects the file
+        """
+        bouncers = header_bouncers(self.bouncers)
+        if not bouncers:
+            return
+        keywords = {y for x in bouncers for y in x.required_tags or []}
+        header = read_header(path, keywords)
+        try:
+            inspect_best_case(bouncers, header, self.bouncer_cache, self.bouncer_order)
+        except DatasetRejected as e:
+            raise DeidentificationError(e) from e
+        except BouncerError:
+            pass  # cannot determine from header. deidentify() will find out
+
+    def write(
+        self, dataset: Dataset, path: PathLike, source: Optional[PathLike] = None
+    ):
+        """Write deidentified dataset to path as a DICOM file
+
+        If dataset was read from source, elements that were not changed are
+        copied from source as they are instead of being encoded again. This
+        includes PixelData, if no pixel processing was done.
+
+        Parameters
+        ----------
+        dataset: Dataset
+            Output of deidentify()
+        path: PathLike
+            Write to this path. Should not be the same as source
+        source: PathLike, optional
+            The file that dataset was read from, if any. Should not have changed
+            since reading
+        """
+        save_as(dataset, path, source)
 
     def deidentify(self, dataset: Dataset) -> Dataset:
         """Try to remove identifiable information from dataset
@@ -180,7 +381,9 @@ class Core(Deidentifier):
         """
         # Check bouncers. Ones that might change after pixel cleaning are returned
         try:
-            maybe_allow = determine_bouncer_results(self.bouncers, dataset)
+            maybe_allow = determine_bouncer_results(
+                self.bouncers, dataset, self.bouncer_cache, self.bouncer_order
+            )
         except (DatasetRejected, BouncerError) as e:
             raise DeidentificationError from e
 
@@ -188,9 +391,11 @@ class Core(Deidentifier):
             # one or more bouncers that currently reject might allow after pixel clean
             dataset = self.apply_pixel_processor(dataset)
         # check again
-        self.apply_bouncers(maybe_allow, dataset)
+        self.apply_bouncers(
+            maybe_allow, dataset, self.bouncer_cache, self.bouncer_order
+        )
 
-        deidentified = self.apply_rules(rules=self.profile.flatten(), dataset=dataset)
+        deidentified = self.apply_rules(rules=self.profile.compile(), dataset=dataset)
 
         # add tags if needed
         for element in self.insertions:
@@ -198,16 +403,123 @@ class Core(Deidentifier):
 
         return deidentified
 
-    def collect_mutations(self, dataset, rules):
-        """Determine mutation for each element in dataset, return non-empty mutations"""
+    def deidentify_many(
+        self,
+        items: Iterable[BatchItem],
+        max_workers: Optional[int] = None,
+        ordered: bool = True,
+    ) -> Iterator[BatchResult]:
+        """Deidentify many datasets in parallel, using a pool of worker processes
+
+        Each worker gets its own copy of this Core. Rejections and errors are
+        recorded in the results instead of raised. See
+        idiscore.batch.deidentify_many() for more options.
 
-        all_mutations = (
-            (x, self.determine_mutation(dataset, x, rules)) for x in dataset
+        Parameters
+        ----------
+        items: Iterable[BatchItem]
+            Datasets, paths to DICOM files, or tuples (path in, path out). If a path
+            out is given, the result is written there instead of returned
+        max_workers: int, optional
+            Number of worker processes. Defaults to the number of CPUs
+        ordered: bool, optional
+            If True, yield results in the same order as items. If False, yield
+            each result as soon as it is done. Defaults to True
+
+        Returns
+        -------
+        Iterator[BatchResult]
+            One result for each item
+        """
+        return deidentify_many(
+            self, items=items, max_workers=max_workers, ordered=ordered
+        )
+
+    def collect_mutations(
+        self,
+        dataset: Dataset,
+        rules: Union[RuleSet, RuleSetOverlay],
+        nested: Optional[List[Dataset]] = None,
+    ) -> Iterator[Tuple[DataElement, Mutation]]:
+        """Determine mutation for each element in dataset, return non-empty mutations
+
+        Which rule applies to each element is taken from plan_cache
+
+        Parameters
+        ----------
+        dataset: Dataset
+            Determine mutations for the elements in this dataset
+        rules: RuleSet or RuleSetOverlay
+            The rules to apply
+        nested: List[Dataset], optional
+            If given, the items of each sequence that should be recursed into are
+            added to this list. Sequences themselves are not mutated.
+
+        Notes
+        -----
+        Elements read from file are only converted from raw bytes to DataElement
+        if needed, see needs_conversion(). Elements that are emptied are converted
+        without reading their value. All others are passed on raw
+        """
+        plan = self.plan_cache.get_plan(rules, dataset)
+        for tag, rule in plan:
+            element = dataset.get_item(tag, keep_deferred=True)
+            if self.needs_conversion(element, rule, dataset):
+                element = dataset[tag]
+            elif isinstance(element, RawDataElement) and self.empties(rule):
+                element = convert_without_value(element, dataset)
+            if nested is not None and self.should_recurse(element, rule):
+                nested.extend(reversed(element.value))  # pop() in original order
+                continue
+            mutation = self.mutation_for_rule(dataset, element, rule, rules)
+            if mutation is not None:
+                yield element, mutation
+
+    @staticmethod
+    def needs_conversion(
+        element: Union[DataElement, RawDataElement],
+        rule: Optional[Rule],
+        dataset: Dataset,
+    ) -> bool:
+        """True if element is raw and has to be converted to a DataElement before
+        rule can be applied
+
+        Raw elements are left as they are if the operator does not need the value,
+        and they are known not to be sequences that need recursing into. Values
+        that are not converted are written back as they were read. Values that
+        were deferred when reading are then never loaded.
+        """
+        if not isinstance(element, RawDataElement):
+            return False
+        if rule and rule.operation.needs_value_for(element):
+            return True
+        if rule and isinstance(rule.operation, (Remove, Empty)):
+            return False  # whole element goes, no need to look into sequences
+        vr = raw_vr_or_none(element, dataset)
+        return vr is None or vr == VRs.Sequence.short_name
+
+    @staticmethod
+    def empties(rule: Optional[Rule]) -> bool:
+        """True if rule replaces the value of an element with an empty value"""
+        return rule is not None and isinstance(rule.operation, Empty)
+
+    @staticmethod
+    def should_recurse(element: DataElement, rule: Optional[Rule]) -> bool:
+        """True if element is a sequence whose items should be processed
+
+        Sequences that are removed or emptied entirely are not recursed into. All
+        other sequences are, as their items might still contain elements that need
+        to be changed.
+        """
+        return element.VR == VRs.Sequence.short_name and not (
+            rule and isinstance(rule.operation, (Remove, Empty))
         )
-        return (x for x in all_mutations if x[1] is not None)
 
     def determine_mutation(
-        self, dataset: Dataset, element: DataElement, rules: RuleSet
+        self,
+        dataset: Dataset,
+        element: DataElement,
+        rules: Union[RuleSet, RuleSetOverlay],
     ) -> Union[None, Mutation]:
         """Find out whether to change, remove or keep the given element.
 
@@ -215,8 +527,8 @@ class Core(Deidentifier):
         -------
         DataElement
             element should be changed to this
-        ElementShouldBeRemoved
-            element should be removed.
+        RemoveElement
+            REMOVE: element should be removed.
         None
             element should be kept as-is.
 
@@ -227,51 +539,100 @@ class Core(Deidentifier):
         memory footprint.
 
         """
-        if element.VR == VRs.Sequence.short_name:  # recurse into sequences
-
-            new = DataElement(
-                tag=element.tag,
-                VR=element.VR,
-                value=Sequence(
-                    [self.apply_rules(rules, sub_dataset) for sub_dataset in element]
-                ),
-            )
-            return new
+        return self.mutation_for_rule(dataset, element, rules.get_rule(element), rules)
+
+    def mutation_for_rule(
+        self,
+        dataset: Dataset,
+        element: DataElement,
+        rule: Optional[Rule],
+        rules: Union[RuleSet, RuleSetOverlay],
+    ) -> Union[None, Mutation]:
+        """Like determine_mutation(), but with the rule for element already known
+
+        Parameters
+        ----------
+        dataset: Dataset
+            The dataset containing element
+        element: DataElement
+            Determine mutation for this element
+        rule: Rule or None
+            The rule for element, as returned by rules.get_rule(element)
+        rules: RuleSet or RuleSetOverlay
+            All rules. Used when recursing into sequences
+
+        Notes
+        -----
+        Rules for sequences are checked before recursing, see should_recurse().
+        Sequence items are modified in-place, so the sequence element itself is
+        never mutated.
+
+        Operators may change element in-place, see Operator.apply_in_place(). An
+        operator returning element itself results in None, as there is nothing
+        left to apply.
+        """
+        if self.should_recurse(element, rule):  # process items in-place
+            for sub_dataset in element:
+                self.apply_rules(rules, sub_dataset)
+            return None
 
-        elif rule := rules.get_rule(element):  # non-sequence
+        elif rule:  # non-sequence, or sequence that does not need recursing
             try:
-                new = rule.operation.apply(element, dataset)
+                if element.tag.is_private_creator:
+                    # changes are checked in apply_private_creator_mutations() first
+                    new = rule.operation.apply(element, dataset)
+                else:
+                    new = rule.operation.apply_in_place(element, dataset)
+                if new is element:  # unchanged, or changed in-place already
+                    return None
                 return new
-            except ElementShouldBeRemoved as e:  # Operator signals removal
-                return e  # Using Exception instance a signal object.. Smelly?
+            except ElementShouldBeRemoved:  # older operators signal removal this way
+                return REMOVE
 
         else:  # no rule found. Leave this element unchanged.
             return None  # explicit return as it signals 'keep this element'
 
     @staticmethod
     def get_private_block_from_creator(ds, private_creator_elem):
-        """Get a private block from an existing private creator element."""
+        """Get a private block from an existing private creator element.
+
+        Deprecated. Use PrivateBlockIndex instead
+        """
+        warnings.warn(
+            "Core.get_private_block_from_creator() is deprecated. Use"
+            " PrivateBlockIndex instead",
+            DeprecationWarning,
+            stacklevel=2,
+        )
         group = private_creator_elem.tag.group
         private_creator_name = private_creator_elem.value
         return ds.private_block(group, private_creator_name, create=False)
 
     @staticmethod
     def get_private_elements_for_block(ds, block):
-        """Get all private elements by checking each possible offset."""
-        private_elems = []
-        for offset in range(0xFF):  # 0x00 to 0xFF
-            if offset in block:
-                private_elems.append(block[offset])
+        """Get all private elements in block
 
-        return private_elems
+        Deprecated. Use PrivateBlockIndex.elements_in_block() instead
+        """
+        warnings.warn(
+            "Core.get_private_elements_for_block() is deprecated. Use"
+            " PrivateBlockIndex.elements_in_block() instead",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        creator_tag = (block.group << 16) | (block.block_start >> 8)
+        return [ds[x] for x in PrivateBlockIndex(ds).elements_in_block(creator_tag)]
 
-    def apply_rules(self, rules: RuleSet, dataset: Dataset) -> Dataset:
+    def apply_rules(
+        self, rules: Union[RuleSet, RuleSetOverlay], dataset: Dataset
+    ) -> Dataset:
         """Apply rules to each element in dataset, recursing into sequence elements
 
         Notes
         -----
         This will modify the input Dataset instance. Modification in-place to minimize
-        memory footprint.
+        memory footprint. Nested sequence items are processed from an explicit
+        stack instead of by recursion, so there is no limit on nesting depth.
         """
 
         # at top level of file, process file_meta tags. Mainly for processing
@@ -280,9 +641,13 @@ class Core(Deidentifier):
             mutations = self.collect_mutations(dataset.file_meta, rules)
             self.apply_mutations(mutations, dataset.file_meta)
 
-        # collect and apply all changes
-        mutations = self.collect_mutations(dataset, rules)
-        self.apply_mutations(mutations, dataset)
+        # collect and apply all changes. Items of nested sequences are added to
+        # to_process while collecting
+        to_process = [dataset]
+        while to_process:
+            current = to_process.pop()
+            mutations = self.collect_mutations(current, rules, nested=to_process)
+            self.apply_mutations(mutations, current)
 
         return dataset
 
@@ -303,7 +668,7 @@ class Core(Deidentifier):
                 private_creator_mutations.append((original, mutation))
             elif isinstance(mutation, DataElement):
                 dataset.add(mutation)  # add overwrites existing
-            elif isinstance(mutation, ElementShouldBeRemoved):
+            elif mutation is REMOVE:
                 del dataset[original.tag]
             else:
                 raise IDISCoreError(
@@ -329,9 +694,10 @@ class Core(Deidentifier):
 
         Notes
         -----
-        Lots of instance creation going on here. Candidate for optimization.
+        Which private elements are left in each block is determined in a single
+        pass over the dataset, after all other mutations have been applied
         """
-
+        index = None
         for (original, mutation) in mutations:
             if isinstance(mutation, DataElement):
                 raise IDISCoreError(
@@ -339,15 +705,17 @@ class Core(Deidentifier):
                     f"tag {original} into {mutation}. This would is too "
                     f"strange to allow."
                 )
-            elif isinstance(mutation, ElementShouldBeRemoved):
-                block = cls.get_private_block_from_creator(dataset, original)
-                all = cls.get_private_elements_for_block(dataset, block)
-                if all:
+            elif mutation is REMOVE:
+                if index is None:
+                    index = PrivateBlockIndex(dataset)
+                remaining = index.elements_in_block(original.tag)
+                if remaining:
                     # removing this would mangle the private block. Don't.
                     warnings.warn(
-                        f"Not removing private creator tag {original} as there"
-                        f" are still {len(all)} private tags that reference "
-                        f"it: {[x for x in all]}",
+                        f"Not removing private creator tag {dataset[original.tag]} "
+                        f"as there"
+                        f" are still {len(remaining)} private tags that reference "
+                        f"it: {', '.join(str(x) for x in remaining)}",  # no loading
                         stacklevel=2,
                     )
                 else:
@@ -406,14 +774,15 @@ class Core(Deidentifier):
         )
 
     @staticmethod
-    def apply_bouncers(bouncers, dataset):
-        """Check all bouncers to see whether dataset should be rejected"""
+    def apply_bouncers(bouncers, dataset, cache=None, order=None):
+        """Check all bouncers to see whether dataset should be rejected. Decisions
+        are taken from cache if given. Bouncers are run in order if given
+        """
 
-        for bouncer in bouncers:
-            try:
-                bouncer.inspect(dataset)
-            except (DatasetRejected, BouncerError) as e:
-                raise DeidentificationError(e) from e
+        try:
+            run_bouncers(bouncers, lambda x: run_bouncer(x, dataset, cache), order)
+        except (DatasetRejected, BouncerError) as e:
+            raise DeidentificationError(e) from e
 
 
 def handle_key_error(func):
@@ -0,0 +1,23 @@
+"""Parsing dicomcriterion expressions like "Modality.equals('CT')"
+
+Shared by bouncers and safe private definitions, so that an expression used in
+both is parsed only once.
+"""
+from functools import lru_cache
+
+from dicomcriterion import Criterion
+
+
+@lru_cache(maxsize=1024)
+def parse_criterion(expression: str) -> Criterion:
+    """Parsed criterion for expression
+
+    Each distinct expression is parsed only once, as long as it is among the 1024
+    most recently used. The returned criterion is shared. Do not modify it.
+
+    Raises
+    ------
+    CriterionError
+        If expression could not be parsed
+    """
+    return Criterion(expression)
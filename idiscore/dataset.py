@@ -1,4 +1,8 @@
 """Additions to the pydicom Dataset object"""
+from collections import ChainMap
+from typing import Any, Dict
+
+from pydicom.datadict import dictionary_VR
 from pydicom.dataset import Dataset
 
 from idiscore.exceptions import IDISCoreError
@@ -46,6 +50,16 @@ class RequiredDataset(Dataset):
                 f"loading)"
             ) from e
 
+    def get(self, key, default=None):
+        """Return default for missing keys, like a regular Dataset
+
+        pydicom itself uses get() for optional elements like SpecificCharacterSet
+        """
+        try:
+            return super().get(key, default)
+        except RequiredTagNotFound:
+            return default
+
     def __getitem__(self, key):
         try:
             return super().__getitem__(key)
@@ -57,5 +71,78 @@ class RequiredDataset(Dataset):
             ) from e
 
 
+class RequiredView:
+    """Like RequiredDataset, but only wraps a dataset instead of creating a new one
+
+    Raises RequiredTagNotFound for missing keys, and otherwise passes everything
+    on to the wrapped dataset. Nothing is copied, so this is cheap enough to
+    create for each inspection of each dataset.
+
+    Raises
+    ------
+    RequiredTagNotFound
+        When a requested key is not found in this dataset. Either through attribute
+        access, like view.PatientID or through dict access like view['PatientID']
+    """
+
+    __slots__ = ("dataset",)
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+
+    def __getattr__(self, name):
+        try:
+            return getattr(self.dataset, name)
+        except AttributeError as e:
+            raise RequiredTagNotFound(f"Required tag not found: {e}") from e
+
+    def __getitem__(self, key):
+        try:
+            return self.dataset[key]
+        except KeyError as e:
+            raise RequiredTagNotFound(f"Required tag not found: {e}") from e
+
+    def __contains__(self, key) -> bool:
+        return key in self.dataset
+
+    def get(self, key, default=None):
+        return self.dataset.get(key, default)
+
+
+class OverlayDataset(Dataset):
+    """A view of a dataset with some element values replaced. The original is not
+    changed
+
+    Reading goes to the replacement elements first, then to the original.
+    Elements added to the view, including elements that are converted from raw
+    on access, are kept in the view only. This makes it safe to inspect a shared
+    dataset from multiple threads through separate views. Element instances are
+    shared with the original, so their values should not be changed.
+
+    Notes
+    -----
+    >>> view = OverlayDataset(dataset, {"BurnedInAnnotation": "NO"})
+    >>> view.BurnedInAnnotation  # "NO", whatever dataset says
+
+    """
+
+    def __init__(self, dataset: Dataset, overlay: Dict[str, Any]):
+        """
+
+        Parameters
+        ----------
+        dataset: Dataset
+            The dataset to view. Is not changed
+        overlay: Dict[str, Any]
+            DICOM keyword: value to show instead of the value in dataset
+        """
+        super().__init__(ChainMap({}, dataset._dict))
+        self._read_little = dataset._read_little
+        self._read_implicit = dataset._read_implicit
+        self._read_charset = dataset._read_charset
+        for keyword, value in overlay.items():  # new elements, in the view only
+            self.add_new(keyword, dictionary_VR(keyword), value)
+
+
 class RequiredTagNotFound(IDISCoreError):
     pass
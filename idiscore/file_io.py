@@ -0,0 +1,377 @@
+"""Reading DICOM files for deidentification without doing more work than needed
+
+Elements that a profile removes unconditionally are dropped straight after
+parsing, while they are still raw bytes. They are never decoded or turned into
+DataElements.
+
+When writing, elements that were not changed are copied straight from the source
+file instead of being encoded again. Large values like PixelData that are
+deferred at read time are then never loaded into memory at all.
+"""
+import os
+from copy import deepcopy
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from pydicom import dcmread, filereader
+from pydicom.charset import default_encoding
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_partial
+from pydicom.filewriter import write_data_element, write_file_meta_info
+from pydicom.tag import BaseTag, Tag
+
+from idiscore.batch import PathLike
+from idiscore.exceptions import IDISCoreError
+from idiscore.rules import RuleSet, RuleSetOverlay
+
+
+def is_prunable(tag: BaseTag) -> bool:
+    """Could this element be dropped when reading?
+
+    Only private elements and elements in repeating groups like curves (50xx,xxxx)
+    and overlays (60xx,xxxx) are considered. Standard elements might still be
+    inspected by bouncers or pixel processors before rules are applied. Private
+    creators are never dropped, as other private rules depend on them.
+    """
+    if tag.is_private:
+        return not tag.is_private_creator
+    return (tag.group & 0xFF00) in (0x5000, 0x6000)
+
+
+def read_header(path: PathLike, keywords: Iterable[str]) -> Dataset:
+    """Read only file meta and the given top-level elements from DICOM file at path
+
+    Reading stops after the last of these elements. Everything in between is
+    skipped without being read. Pixel data is never reached, as it comes last.
+
+    Parameters
+    ----------
+    path: PathLike
+        Read this file
+    keywords: Iterable[str]
+        DICOM keywords of the elements to read, like "SOPClassUID"
+
+    Raises
+    ------
+    InvalidDicomError
+        If path is not a valid DICOM file
+    """
+    tags: List[Union[BaseTag, int]] = [Tag(x) for x in keywords]
+    last = max(tags, default=Tag(0))
+    with open(path, "rb") as f:
+        return read_partial(
+            f, stop_when=lambda tag, vr, length: tag > last, specific_tags=tags
+        )
+
+
+class PruningReader:
+    """Reads DICOM files, dropping elements that will be removed anyway
+
+    Which tags to drop is determined per rule set and remembered, so that this is
+    decided only once for each tag
+    """
+
+    def __init__(self, defer_size: Optional[Union[int, str]] = None):
+        """
+
+        Parameters
+        ----------
+        defer_size: int or str, optional
+            Passed to pydicom.dcmread(). Values larger than this are only read
+            from disk when accessed. Defaults to None, meaning all values are read
+        """
+        self.defer_size = defer_size
+        self._rules_key: Optional[Tuple[Union[RuleSet, RuleSetOverlay], int]] = None
+        self._decisions: Dict[int, bool] = {}
+
+    def __getstate__(self):
+        """Decisions are not pickled. They hold on to the rules they were for"""
+        state = self.__dict__.copy()
+        state["_rules_key"] = None
+        state["_decisions"] = {}
+        return state
+
+    def read(self, path: PathLike, rules: Union[RuleSet, RuleSetOverlay]) -> Dataset:
+        """Read DICOM file, dropping elements that rules would remove anyway
+
+        Raises
+        ------
+        InvalidDicomError
+            If path is not a valid DICOM file
+        """
+        dataset = dcmread(path, defer_size=self.defer_size)
+        self.prune(dataset, rules)
+        return dataset
+
+    def prune(self, dataset: Dataset, rules: Union[RuleSet, RuleSetOverlay]) -> int:
+        """Delete all top-level elements from dataset that rules would remove anyway
+
+        Returns
+        -------
+        int
+            The number of elements deleted
+        """
+        to_delete = [x for x in dataset.keys() if self.should_prune(x, rules)]
+        for tag in to_delete:
+            del dataset[tag]
+        return len(to_delete)
+
+    def should_prune(self, tag: BaseTag, rules: Union[RuleSet, RuleSetOverlay]) -> bool:
+        """True if element with this tag can be dropped when reading"""
+        if not is_prunable(tag):
+            return False
+        if self._rules_key != (rules, rules.revision):
+            self._rules_key = (rules, rules.revision)
+            self._decisions = {}
+        try:
+            return self._decisions[tag]
+        except KeyError:
+            decision = self._decisions[tag] = rules.removes_unconditionally(tag)
+            return decision
+
+
+class DeferredLoads:
+    """Records each deferred value that is read from disk while active
+
+    For checking that deidentification does not load large values like PixelData
+    when datasets are read with a defer_size
+
+    Example
+    -------
+    >>> with DeferredLoads() as loads:
+    >>>     core.write(core.deidentify(core.read(path)), path_out, path)
+    >>> loads.assert_none()
+
+    Notes
+    -----
+    Works by temporarily replacing pydicom.filereader.read_deferred_data_element().
+    Meant for testing. Not thread-safe
+    """
+
+    def __init__(self):
+        self.tags: List[BaseTag] = []  # of each value loaded, in order
+        self._original = None
+
+    def __enter__(self):
+        self._original = original = filereader.read_deferred_data_element
+
+        def read_and_record(fileobj_type, filename_or_obj, timestamp, raw_data_elem):
+            self.tags.append(raw_data_elem.tag)
+            return original(fileobj_type, filename_or_obj, timestamp, raw_data_elem)
+
+        filereader.read_deferred_data_element = read_and_record
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        filereader.read_deferred_data_element = self._original
+
+    def assert_none(self):
+        """Raise exception if any deferred value was loaded
+
+        Raises
+        ------
+        DeferredValueLoaded
+            If any deferred value was loaded
+        """
+        if self.tags:
+            raise DeferredValueLoaded(
+                f"{len(self.tags)} deferred value(s) were loaded: "
+                f"{', '.join(str(x) for x in self.tags)}"
+            )
+
+
+class DeferredValueLoaded(IDISCoreError):
+    pass
+
+
+# Explicit VR elements with these VRs have a 12 byte header, all others 8 bytes
+LONG_HEADER_VRS = {
+    "OB",
+    "OD",
+    "OF",
+    "OL",
+    "OV",
+    "OW",
+    "SQ",
+    "SV",
+    "UC",
+    "UN",
+    "UR",
+    "UT",
+    "UV",
+}
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def source_range(element, is_implicit_vr: bool) -> Optional[Tuple[int, int]]:
+    """Start and end offset of element in the file it was read from
+
+    Returns
+    -------
+    Tuple[int, int] or None
+        (start, end) of the encoded element including its header. None if element
+        is not an unchanged raw element, or if its length is undefined
+    """
+    if not isinstance(element, RawDataElement):
+        return None
+    if element.length == UNDEFINED_LENGTH or element.value_tell is None:
+        return None
+    if is_implicit_vr or element.VR not in LONG_HEADER_VRS:
+        header = 8
+    else:
+        header = 12
+    return element.value_tell - header, element.value_tell + element.length
+
+
+def can_splice(dataset: Dataset, source: Optional[PathLike]) -> bool:
+    """Can dataset be written by copying unchanged elements from source?
+
+    Only if dataset was read from source with the transfer syntax it still has,
+    without compression of the dataset as a whole, and with the character set
+    it still has.
+    """
+    if not source or not os.path.isfile(source):
+        return False
+    file_meta = getattr(dataset, "file_meta", None)
+    transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta else None
+    if not transfer_syntax or transfer_syntax.is_deflated:
+        return False
+    encoding = (transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian)
+    if getattr(dataset, "original_encoding", None) != encoding:
+        return False
+    return dataset.original_character_set == dataset._character_set
+
+
+def copy_range(source_fd: int, destination_fd: int, offset: int, count: int):
+    """Copy count bytes at offset in source to the current position of destination
+
+    Uses os.copy_file_range() or os.sendfile() where the platform supports it, so
+    that bytes are not copied through Python. Falls back to reading and writing
+    in chunks.
+    """
+    for method in (_copy_file_range, _sendfile, _read_write):
+        try:
+            while count > 0:
+                copied = method(source_fd, destination_fd, offset, count)
+                if not copied:
+                    raise EOFError(f"Could not read {count} bytes at {offset}")
+                offset += copied
+                count -= copied
+            return
+        except (AttributeError, OSError):
+            if method is _read_write:
+                raise  # nothing left to fall back on
+
+
+def _copy_file_range(source_fd: int, destination_fd: int, offset: int, count: int):
+    return os.copy_file_range(source_fd, destination_fd, count, offset)
+
+
+def _sendfile(source_fd: int, destination_fd: int, offset: int, count: int):
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+def _read_write(source_fd: int, destination_fd: int, offset: int, count: int):
+    return os.write(destination_fd, os.pread(source_fd, min(count, 2**20), offset))
+
+
+def save_as(dataset: Dataset, destination: PathLike, source: Optional[PathLike]):
+    """Write dataset to destination as a DICOM file
+
+    If dataset was read from source, unchanged elements are copied from source
+    byte for byte. Only elements that were changed or inserted are encoded.
+    Otherwise, or if dataset's encoding has changed since reading, this is the
+    same as dataset.save_as(destination). Preamble and file meta are written as
+    dataset.save_as() writes them. dataset is not changed
+
+    Parameters
+    ----------
+    dataset: Dataset
+        Write this
+    destination: PathLike
+        Write to this path. Should not be the same as source
+    source: PathLike, optional
+        The file dataset was read from, if any. Should not have changed since
+        reading
+    """
+    if (
+        source is None
+        or not can_splice(dataset, source)
+        or os.path.exists(destination)
+        and os.path.samefile(source, destination)
+    ):
+        dataset.save_as(destination)
+        return
+
+    try:
+        write_spliced(dataset, destination, source)
+    except EOFError:  # source is shorter than when dataset was read from it
+        os.remove(destination)
+        dataset.save_as(destination)
+
+
+def write_header(fp: DicomBytesIO, dataset: Dataset):
+    """Write preamble, 'DICM' prefix and file meta of dataset, like pydicom does
+
+    The 'DICM' prefix is written only with a preamble. dataset is not changed
+    """
+    preamble = getattr(dataset, "preamble", None)
+    if preamble:
+        fp.write(preamble)
+        fp.write(b"DICM")
+    if dataset.file_meta:
+        # a copy, as this adds group length and implementation elements
+        file_meta = deepcopy(dataset.file_meta)
+        write_file_meta_info(fp, file_meta, enforce_standard=False)
+
+
+def write_spliced(dataset: Dataset, destination: PathLike, source: PathLike):
+    """Write dataset to destination, copying unchanged elements from source
+
+    See save_as(), which checks whether this is possible
+
+    Raises
+    ------
+    EOFError
+        If source is too short to copy an unchanged element from. Destination is
+        then only partly written
+    """
+    # known for a dataset read from source, see can_splice()
+    is_implicit_vr, is_little_endian = (bool(x) for x in dataset.original_encoding)
+    encodings = dataset.get("SpecificCharacterSet", default_encoding)
+    encoded = DicomBytesIO()
+    encoded.is_implicit_VR = is_implicit_vr
+    encoded.is_little_endian = is_little_endian
+    write_header(encoded, dataset)
+
+    with open(source, "rb") as source_file, open(destination, "wb") as file:
+        ranges: List[Tuple[int, int]] = []  # unchanged elements, not written yet
+
+        def flush():
+            """Write pending encoded bytes, then copy pending ranges"""
+            file.write(encoded.getvalue())
+            file.flush()
+            encoded.parent.seek(0)
+            encoded.parent.truncate()
+            for start, end in ranges:
+                copy_range(source_file.fileno(), file.fileno(), start, end - start)
+            ranges.clear()
+
+        for tag in sorted(dataset.keys()):
+            if tag.element == 0 and tag.group > 6:
+                continue  # group lengths are not written, like pydicom does
+            element = dataset.get_item(tag, keep_deferred=True)
+            byte_range = source_range(element, is_implicit_vr)
+            if byte_range is None:
+                if ranges:
+                    flush()
+                write_data_element(encoded, dataset.get_item(tag), encodings)
+            elif ranges and ranges[-1][1] == byte_range[0]:
+                ranges[-1] = (ranges[-1][0], byte_range[1])  # contiguous, merge
+            else:
+                if encoded.tell():
+                    flush()  # keep encoded and copied elements in order
+                ranges.append(byte_range)
+        flush()
@@ -40,10 +40,23 @@ class TagIdentifier:
       Tag(tag.key()) == tag
     """
 
+    # If True, mask_and_value() fully determines matching and matches() does not
+    # need to be called
+    exact_mask = False
+
     def matches(self, element: DataElement) -> bool:
         """The given element matches this identifier"""
         return False
 
+    def mask_and_value(self) -> Tuple[int, int]:
+        """Bit mask and value such that tag & mask == value for every tag that this
+        identifier matches. Used for fast pre-selection of candidate tags.
+
+        Not all identifiers can be expressed this way. If exact_mask is False,
+        matches() should still be called for candidates.
+        """
+        return 0x00000000, 0x00000000  # matches anything. No pre-selection
+
     def key(self) -> str:
         """String used in comparison operators
 
@@ -89,6 +102,8 @@ class TagIdentifier:
 class SingleTag(TagIdentifier):
     """Matches a single DICOM tag like (0010,0010) or 'PatientName'"""
 
+    exact_mask = True
+
     def __init__(self, tag: Union[BaseTag, str, Tuple[int, int]]):
         """
 
@@ -111,6 +126,9 @@ class SingleTag(TagIdentifier):
         """The given element matches this identifier"""
         return element.tag == self.tag
 
+    def mask_and_value(self) -> Tuple[int, int]:
+        return 0xFFFFFFFF, int(self.tag)
+
     def key(self) -> str:
         """Return a valid Tag() string argument"""
         return clean_tag_string(str(self.tag))
@@ -149,6 +167,11 @@ class RepeatingTag:
                 f'Invalid format "{tag}":{e}. Examples of valid tag '
                 f'strings: "(0010,xx10)", "0010,xx10", "0010xx10"'
             ) from e
+        # parse once. These are used for every match
+        self._mask = int(
+            f"0x{''.join(map(lambda x: '0' if x == 'x' else 'f', self.tag))}", 0
+        )
+        self._static_component = int(f'0x{self.tag.replace("x", "0")}', 0)
 
     def __str__(self):
         """Output format matches pydicom.tag.Tag.__str__()"""
@@ -196,20 +219,21 @@ class RepeatingTag:
         RepeatingTag('0010,xx10').as_mask() -> 0xffff00ff
         RepeatingTag('50xx,xxxx').as_mask() -> 0xff000000
         """
-        hex_string = f"0x{''.join(map(lambda x: '0' if x == 'x' else 'f', self.tag))}"
-        return int(hex_string, 0)
+        return self._mask
 
     def static_component(self) -> int:
         """The int value of all bytes of this tag that are not 'x'
         RepeatingTag('0010,xx10').static_component() -> 0x00100010
         RepeatingTag('50xx,xxxx').static_component() -> 0x50000000
         """
-        return int(f'0x{self.tag.replace("x", "0")}', 0)
+        return self._static_component
 
 
 class RepeatingGroup(TagIdentifier):
     """A DICOM tag where not all elements are filled. Like (50xx,xxxx)"""
 
+    exact_mask = True
+
     def __init__(self, tag: Union[str, RepeatingTag]):
         if isinstance(tag, str):  # allow string init for convenience
             tag = RepeatingTag(tag.replace(" ", ""))  # allow (xxxx, xxxx)
@@ -223,6 +247,9 @@ class RepeatingGroup(TagIdentifier):
         # Following pydicom in using byte operations for this
         return element.tag & self.tag.as_mask() == self.tag.static_component()
 
+    def mask_and_value(self) -> Tuple[int, int]:
+        return self.tag.as_mask(), self.tag.static_component()
+
     def key(self) -> str:
         """For sane sorting, make sure this matches the key format of other
         identifiers
@@ -244,12 +271,17 @@ class RepeatingGroup(TagIdentifier):
 class PrivateTags(TagIdentifier):
     """Matches any private DICOM tag. A private tag has an uneven group number"""
 
+    exact_mask = True
+
     def __str__(self):
         return self.key()
 
     def matches(self, element: DataElement) -> bool:
         return element.tag.is_private
 
+    def mask_and_value(self) -> Tuple[int, int]:
+        return 0x00010000, 0x00010000  # lowest bit of group is set
+
     def key(self) -> str:
         return "PrivateAttributes"
 
@@ -388,6 +420,10 @@ class PrivateBlockTagIdentifier(TagIdentifier):
         else:
             return True
 
+    def mask_and_value(self) -> Tuple[int, int]:
+        """Group and last two bytes of element. Private creator is not included"""
+        return 0xFFFF00FF, (self.group << 16) | self.element
+
     def key(self) -> str:
         """For sane sorting, make sure this matches the key format of other
         identifiers
@@ -2,6 +2,7 @@
 from dataclasses import dataclass
 from typing import Callable, List, Optional
 
+from pydicom.dataelem import RawDataElement
 from pydicom.dataset import Dataset
 
 from idiscore.exceptions import IDISCoreError
@@ -9,12 +10,35 @@ from idiscore.exceptions import IDISCoreError
 
 @dataclass(frozen=True)
 class SquareArea:
-    """A 2D square in pixel coordinates"""
+    """A 2D square in pixel coordinates, in all frames or in a range of frames
+
+    Frames are numbered from 0, like numpy indices. For example, frames=range(0, 10)
+    means the first ten frames. None means all frames
+    """
 
     origin_x: int
     origin_y: int
     width: int
     height: int
+    frames: Optional[range] = None
+
+    def blackout(self, pixels):
+        """Set this area to 0 in all its frames and samples at once
+
+        Parameters
+        ----------
+        pixels: numpy.ndarray
+            Array with axes (frames, rows, columns, samples)
+        """
+        if self.frames is None:
+            frames = slice(None)
+        else:
+            frames = slice(self.frames.start, self.frames.stop, self.frames.step)
+        pixels[
+            frames,
+            self.origin_y : self.origin_y + self.height,
+            self.origin_x : self.origin_x + self.width,
+        ] = 0
 
 
 class PIILocation:
@@ -23,7 +47,8 @@ class PIILocation:
 
     Notes
     -----
-    A PIILocation is 2D. Cleaning will be done on each slice individually.
+    A PIILocation is 2D. Cleaning will be done on each frame of a multi-frame
+    dataset, or only on the frames given for each area.
 
     Responsibilities:
 
@@ -134,23 +159,150 @@ class PixelProcessor:
         if not areas:
             pass
         else:
-            pixel_array = dataset.pixel_array
-            for area in areas:
-
-                # extract the square location an set its value to 0
-                pixel_array[
-                    area.origin_y : area.origin_y + area.height,
-                    area.origin_x : area.origin_x + area.width,
-                ] = 0
-
-            # write back data
-            dataset.PixelData = pixel_array.tobytes()
+            layout = NativePixelLayout.of(dataset)
+            if layout:
+                self.clean_in_place(dataset, areas, layout)
+            else:
+                self.clean_decoded(dataset, areas)
 
             # mark as having no burned in annotation as per PS3.15 E3.1
             dataset.BurnedInAnnotation = "NO"
 
         return dataset
 
+    @staticmethod
+    def clean_decoded(dataset: Dataset, areas: List[SquareArea]):
+        """Set areas to 0 by decoding PixelData, then encoding it again
+
+        pixel_array has samples interleaved whatever the planar configuration, so
+        PixelData is written back interleaved and PlanarConfiguration set to match
+        """
+        frames = int(dataset.get("NumberOfFrames") or 1)
+        pixels = dataset.pixel_array.reshape(frames, dataset.Rows, dataset.Columns, -1)
+        for area in areas:
+            area.blackout(pixels)
+
+        # write back data
+        if pixels.shape[3] > 1:
+            dataset.PlanarConfiguration = 0
+        dataset.PixelData = pixels.tobytes()
+
+    @staticmethod
+    def clean_in_place(
+        dataset: Dataset,
+        areas: List[SquareArea],
+        layout: Optional["NativePixelLayout"] = None,
+    ):
+        """Set areas to 0 in the bytes of PixelData, without decoding
+
+        For uncompressed little endian PixelData only. This is not zero-copy:
+        PixelData is copied into a writable bytearray, and the result is copied
+        back into bytes, as pydicom only accepts bytes as value. The original value
+        is dropped before the second copy, so peak memory is twice the size of
+        PixelData. Decoding needs three times the size.
+
+        Parameters
+        ----------
+        dataset: Dataset
+            Clean PixelData of this dataset
+        areas: List[SquareArea]
+            Set these to 0
+        layout: NativePixelLayout, optional
+            Layout of PixelData in dataset. Determined from dataset if not given
+
+        Raises
+        ------
+        ValueError
+            If PixelData is not uncompressed little endian
+        """
+        if layout is None:
+            layout = NativePixelLayout.of(dataset)
+        if layout is None:
+            raise ValueError("PixelData is not uncompressed little endian")
+        buffer = bytearray(dataset.PixelData)
+        dataset.PixelData = b""  # drop the original before copying back
+        pixels = layout.view(buffer)
+        for area in areas:
+            area.blackout(pixels)
+        del pixels  # release buffer
+        dataset.PixelData = bytes(buffer)  # second copy
+
+
+@dataclass(frozen=True)
+class NativePixelLayout:
+    """How uncompressed little endian PixelData is laid out in bytes"""
+
+    frames: int
+    rows: int
+    columns: int
+    samples: int
+    bits_allocated: int
+    planar: bool  # all values of each sample together, PlanarConfiguration 1
+
+    @classmethod
+    def of(cls, dataset: Dataset) -> Optional["NativePixelLayout"]:
+        """Layout of PixelData in dataset
+
+        Returns
+        -------
+        NativePixelLayout or None
+            None if PixelData is compressed, big endian, has a BitsAllocated that is
+            not a whole number of bytes, or is shorter than its attributes say
+        """
+        file_meta = getattr(dataset, "file_meta", None)
+        transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta else None
+        if (
+            not transfer_syntax
+            or transfer_syntax.is_encapsulated
+            or not transfer_syntax.is_little_endian
+            or "PixelData" not in dataset
+            or dataset.get("BitsAllocated") not in (8, 16, 32, 64)
+            or not dataset.get("Rows")
+            or not dataset.get("Columns")
+        ):
+            return None
+
+        samples = dataset.get("SamplesPerPixel") or 1
+        layout = cls(
+            frames=int(dataset.get("NumberOfFrames") or 1),
+            rows=dataset.Rows,
+            columns=dataset.Columns,
+            samples=samples,
+            bits_allocated=dataset.BitsAllocated,
+            planar=samples > 1 and dataset.get("PlanarConfiguration") == 1,
+        )
+        element = dataset.get_item("PixelData", keep_deferred=True)
+        if isinstance(element, RawDataElement):
+            length = element.length
+        else:
+            length = len(element.value)
+        if length < layout.size:
+            return None
+        return layout
+
+    @property
+    def size(self) -> int:
+        """Number of bytes of PixelData, without padding"""
+        pixels = self.frames * self.rows * self.columns * self.samples
+        return pixels * self.bits_allocated // 8
+
+    def view(self, buffer: bytearray):
+        """Writable numpy array on buffer, without copying
+
+        Axes are (frames, rows, columns, samples), whatever the planar
+        configuration. Changing the array changes buffer. numpy is imported here,
+        as it is only needed for cleaning pixel data
+        """
+        import numpy as np
+
+        dtype = f"<u{self.bits_allocated // 8}"
+        count = self.size * 8 // self.bits_allocated
+        pixels = np.frombuffer(buffer, dtype=dtype, count=count)
+        if self.planar:
+            planes = pixels.reshape(self.frames, self.samples, self.rows, self.columns)
+            return planes.transpose(0, 2, 3, 1)
+        return pixels.reshape(self.frames, self.rows, self.columns, self.samples)
+
 
 class CriterionException(IDISCoreError):
     pass
@@ -7,7 +7,7 @@ from typing import Optional, Tuple, Union
 
 from dicomgenerator.dicom import VRs
 from dicomgenerator.generators import DataElementFactory
-from pydicom.dataelem import DataElement
+from pydicom.dataelem import DataElement, RawDataElement
 from pydicom.dataset import Dataset
 
 from idiscore.dicom import ActionCodes
@@ -16,6 +16,20 @@ from idiscore.private_processing import SafePrivateDefinition
 from idiscore.settings import IDIS_CORE_ROOT_UID
 
 
+class RemoveElement:
+    """Signal returned by an operator to say 'remove this element from the dataset'.
+
+    Operators cannot remove elements by themselves as they can only operate on the
+    element given. Do not instantiate, use the single instance REMOVE
+    """
+
+    def __repr__(self):
+        return "REMOVE"
+
+
+REMOVE = RemoveElement()
+
+
 class Operator:
     """Base class for something that can change a DICOM data element.
 
@@ -29,6 +43,9 @@ class Operator:
     nema_action_code: ActionCode
         The action from DICOM table E1-1 that this operator implements. For generating
         tag-action lists for profiles that can be readily compared to the DICOM standard
+    needs_value: bool
+        If False, apply() only looks at the tag of the element. Elements read from
+        file are then passed without converting their value from raw bytes first
 
     Notes
     -----
@@ -40,15 +57,19 @@ class Operator:
     * Can inspect the dataset that is passed to it
     * Can take init arguments and connect to external resources if needed
     * Should NOT alter the dataset that is passed to it
+    * Can return the element that was passed to it to signal 'unchanged'. The
+      element is then left alone entirely
+    * Can return REMOVE to signal that the element should be removed
 
     """
 
     name = "Base Operation"
     nema_action_code = ActionCodes.UNDEFINED
+    needs_value = True
 
     def apply(
         self, element: DataElement, dataset: Optional[Dataset] = None
-    ) -> DataElement:
+    ) -> Union[DataElement, RemoveElement]:
         """Perform this operation on the given element.
 
         Parameters
@@ -63,7 +84,10 @@ class Operator:
         Returns
         -------
         DataElement
-            A new DataElement instance to replace the given element with
+            A new DataElement instance to replace the given element with, or
+            the given element itself if it should not be changed
+        RemoveElement
+            REMOVE, if this element should be removed from the dataset
 
         Raises
         ------
@@ -71,14 +95,29 @@ class Operator:
             When this operation cannot be performed on this element. For example
             when the data element has a number ValueType but the operation is for
             a string
-        ElementShouldBeRemoved
-            Signals that this element should be removed from the dataset. Operators
-            cannot do this by themselves as they can only operate on the element
-            given
 
         """
         return element
 
+    def apply_in_place(
+        self, element: DataElement, dataset: Optional[Dataset] = None
+    ) -> Union[DataElement, RemoveElement]:
+        """Like apply(), but allowed to change element itself instead of copying.
+
+        Used by Core, which modifies datasets in-place anyway. Returning element
+        itself means 'nothing more to do'. Override this for operators that can
+        avoid creating a new element. Defaults to apply()
+        """
+        return self.apply(element, dataset)
+
+    def needs_value_for(self, element: Union[DataElement, RawDataElement]) -> bool:
+        """Does apply() need the value of this particular element?
+
+        Like needs_value, but per element. If False, element may be passed to
+        apply() as a RawDataElement, unconverted. Defaults to needs_value
+        """
+        return self.needs_value
+
     def __str__(self):
         var_name = self.nema_action_code.var_name
         if self.name.lower() == var_name.lower():
@@ -92,11 +131,12 @@ class Keep(Operator):
 
     name = "Keep"
     nema_action_code = ActionCodes.KEEP
+    needs_value = False
 
     def apply(
         self, element: DataElement, dataset: Optional[Dataset] = None
     ) -> DataElement:
-        return copy(element)
+        return element  # unchanged
 
 
 class Remove(Operator):
@@ -104,9 +144,12 @@ class Remove(Operator):
 
     name = "Remove"
     nema_action_code = ActionCodes.REMOVE
+    needs_value = False
 
-    def apply(self, element: DataElement, dataset: Optional[Dataset] = None):
-        raise ElementShouldBeRemoved()
+    def apply(
+        self, element: DataElement, dataset: Optional[Dataset] = None
+    ) -> RemoveElement:
+        return REMOVE
 
 
 class Empty(Operator):
@@ -114,6 +157,7 @@ class Empty(Operator):
 
     name = "Empty"
     nema_action_code = ActionCodes.EMPTY
+    needs_value = False  # value is replaced. Element still has to be converted
 
     def apply(
         self, element: DataElement, dataset: Optional[Dataset] = None
@@ -122,6 +166,12 @@ class Empty(Operator):
         copied.value = None
         return copied
 
+    def apply_in_place(
+        self, element: DataElement, dataset: Optional[Dataset] = None
+    ) -> DataElement:
+        element.value = None
+        return element
+
 
 class TimeDeltaProvider:
     """Generates a random shift in time to use when cleaning dates.
@@ -211,17 +261,17 @@ class Clean(Operator):
 
     def apply(
         self, element: DataElement, dataset: Optional[Dataset] = None
-    ) -> DataElement:
-        vr = VRs.short_name_to_vr(element.VR)
-
+    ) -> Union[DataElement, RemoveElement]:
         if element.tag.is_private:
             return self.clean_private(element, dataset)
-        elif VRs.is_date_like(element.VR):
+
+        vr = VRs.short_name_to_vr(element.VR)
+        if VRs.is_date_like(element.VR):
             return self.clean_date_time(element, dataset)
         elif VRs.is_string_like(element.VR):
             return DataElement(tag=element.tag, VR=element.VR, value="CLEANED")
         elif VRs.is_sequence(element.VR):
-            return copy(element)  # sequence elements are processed later. pass
+            return element  # sequence elements are processed later. pass
         else:
             # too difficult. Cannot do it
             raise ValueError(
@@ -229,12 +279,18 @@ class Clean(Operator):
                 f"tags of type '{vr}'"
             )
 
-    def clean_private(self, element: DataElement, dataset: Dataset) -> DataElement:
+    def needs_value_for(self, element: Union[DataElement, RawDataElement]) -> bool:
+        """Private elements are kept or removed based on their tag only"""
+        return not element.tag.is_private
+
+    def clean_private(
+        self, element: DataElement, dataset: Dataset
+    ) -> Union[DataElement, RemoveElement]:
         """Clean private DICOM element"""
         if self.is_safe(element=element, dataset=dataset):
-            return copy(element)  # Nothing needs to be done. Keep.
+            return element  # Nothing needs to be done. Keep.
         else:
-            raise ElementShouldBeRemoved()  # not safe. Remove
+            return REMOVE  # not safe
 
     def clean_date_time(self, element: DataElement, dataset: Dataset) -> DataElement:
         """Clean a DICOM date or time
@@ -405,4 +461,8 @@ class SetFixedValue(Operator):
 
 
 class ElementShouldBeRemoved(IDISCoreError):
-    pass
+    """Raised by an operator to signal removal of an element.
+
+    Deprecated. Still supported for existing operators, but return REMOVE instead.
+    Raising an exception for each removed element is slow
+    """
@@ -4,17 +4,113 @@ Is a private tag is safe to keep? This can not be answered with regular rules of
 the form tag -> operation. Sometimes you need to inspect the entire dataset, for
 example to check modality or vendor.
 """
+import csv
 import itertools
-from typing import Callable, Iterable, List, Optional, Set, Union
+import json
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
+from dicomcriterion import CriterionError, EvaluationError
 from pydicom.dataelem import DataElement
 from pydicom.dataset import Dataset
+from pydicom.tag import BaseTag
 
+from idiscore.criteria import parse_criterion
 from idiscore.exceptions import SafePrivateError
 from idiscore.identifiers import PrivateBlockTagIdentifier, TagIdentifier
 from idiscore.image_processing import CriterionException
 
 
+def private_creator_of(dataset: Dataset, tag: int) -> Optional[str]:
+    """The private creator value for the given private element tag, if any"""
+    creator = dataset.get((tag & 0xFFFF0000) | ((tag & 0xFF00) >> 8))
+    return creator.value if creator is not None else None
+
+
+class PrivateBlockIndex:
+    """The private creators and private elements in a dataset
+
+    Built in a single pass over the tags of the dataset, without converting any
+    element other than private creators. A private block is identified by its
+    group and block byte. Private creator (0013,0010) reserves block 0x10, which
+    holds elements (0013,1000) to (0013,10FF)
+
+    Notes
+    -----
+    This is a snapshot. It is not updated when the dataset changes
+    """
+
+    def __init__(self, dataset: Dataset):
+        # (group, block) -> private creator value
+        self.creators: Dict[Tuple[int, int], str] = {}
+        # (group, block) -> tags of private elements in that block
+        self.elements: Dict[Tuple[int, int], List[BaseTag]] = {}
+
+        for tag in dataset.keys():
+            if not tag & 0x00010000:  # odd group means private
+                continue
+            group, element = tag >> 16, tag & 0xFFFF
+            if 0x0010 <= element <= 0x00FF:  # private creator
+                self.creators[(group, element)] = dataset[tag].value
+            elif element >= 0x1000:
+                self.elements.setdefault((group, element >> 8), []).append(tag)
+
+    def creator(self, tag: int) -> Optional[str]:
+        """The private creator for the given private element tag, if any"""
+        return self.creators.get((tag >> 16, (tag & 0xFF00) >> 8))
+
+    def elements_in_block(self, creator_tag: int) -> List[BaseTag]:
+        """Tags of all private elements in the block reserved by the given private
+        creator tag
+        """
+        return self.elements.get((creator_tag >> 16, creator_tag & 0x00FF), [])
+
+
+class StringCriterion:
+    """A criterion given as dicomcriterion expression, like "Modality.equals('CT')"
+
+    Each distinct expression is parsed only once, see parse_criterion(). This
+    keeps loading large catalogues fast.
+    """
+
+    def __init__(self, expression: str):
+        """
+
+        Parameters
+        ----------
+        expression: str
+            dicomcriterion expression
+
+        Raises
+        ------
+        CriterionError
+            If expression could not be parsed
+        """
+        self.expression = expression.strip()
+        self.criterion = parse_criterion(self.expression)
+
+    def __call__(self, dataset: Dataset) -> bool:
+        try:
+            return self.criterion.evaluate(dataset)
+        except EvaluationError as e:
+            raise CriterionException(f"Error while checking {self}") from e
+
+    def __str__(self):
+        return self.expression
+
+
 class SafePrivateBlock:
     """Defines when one or more private DICOM elements can be considered 'safe'
 
@@ -24,8 +120,9 @@ class SafePrivateBlock:
     def __init__(
         self,
         tags: Iterable[Union[PrivateBlockTagIdentifier, str]],
-        criterion: Optional[Callable[[Dataset], bool]] = None,
+        criterion: Optional[Union[Callable[[Dataset], bool], str]] = None,
         comment: str = "",
+        series_level: bool = False,
     ):
         """
 
@@ -34,18 +131,27 @@ class SafePrivateBlock:
         tags: Iterable[Union[PrivateBlockTagIdentifier, str]]
             One ore more Tags of private DICOM elements, or strings representing such
             elements
-        criterion: Callable[[Dataset], bool], optional
+        criterion: Callable[[Dataset], bool] or str, optional
             Function that is fed a Dataset instance. Returns True if the private
             elements are safe to keep in the dataset. May raise CriterionException
-            if a True or False answer cannot be given. Defaults to None, in which
-            case tags are always considered safe regardless of the containing dataset
+            if a True or False answer cannot be given. A string is read as a
+            dicomcriterion expression, like "Modality.equals('CT')". Defaults to
+            None, in which case tags are always considered safe regardless of the
+            containing dataset
         comment: str
             human readable explanation of why these tags are safe, or the domain in
             which they are safe (only in this hospital, only for these machines etc.)
+        series_level: bool, optional
+            Set to True if criterion only inspects attributes that are the same for
+            all datasets in a series, like Modality or Manufacturer. Criterion is
+            then checked once per SeriesInstanceUID. Defaults to False
         """
         self.tags = [self.to_tag_identifier(x) for x in tags]
+        if isinstance(criterion, str):  # cast from str for convenience
+            criterion = StringCriterion(criterion)
         self.criterion = criterion
         self.comment = comment
+        self.series_level = series_level
 
     @staticmethod
     def to_tag_identifier(
@@ -68,6 +174,10 @@ class SafePrivateBlock:
         else:
             return PrivateBlockTagIdentifier(tag_or_string)
 
+    def keys(self) -> Set[Tuple[int, str, int]]:
+        """(group, private creator, element byte) for each tag in this block"""
+        return {(x.group, x.private_creator, x.element) for x in self.tags}
+
     def get_safe_private_tags(self, dataset: Dataset) -> Set[TagIdentifier]:
         """The private tags that are safe to keep, given this dataset
 
@@ -96,10 +206,141 @@ class SafePrivateDefinition:
     """Holds all information on which private tags can be considered safe
 
     Contains one or more SafePrivateBlocks
+
+    Notes
+    -----
+    Which tags are safe is determined once per dataset, and remembered until
+    is_safe() is called for a different dataset. If a dataset is changed in a way
+    that affects block criteria between calls, call clear_cache().
+    For blocks marked series_level the result is remembered per
+    SeriesInstanceUID as well.
+
+    Only blocks with tags for private creators that are actually in the dataset
+    are checked. Blocks are indexed by (group, private creator) for this
     """
 
-    def __init__(self, blocks: List[SafePrivateBlock]):
+    def __init__(self, blocks: List[SafePrivateBlock], max_series: int = 256):
+        """
+
+        Parameters
+        ----------
+        blocks: List[SafePrivateBlock]
+            All safe private blocks
+        max_series: int, optional
+            Remember results of series-level blocks for at most this many series.
+            Defaults to 256
+        """
         self.blocks = blocks
+        self.max_series = max_series
+        self._last_dataset: Optional[weakref.ref] = None
+        self._last_keys: FrozenSet[Tuple[int, str, int]] = frozenset()
+        self._series_results: OrderedDict = OrderedDict()
+        self._indexed_blocks: List[SafePrivateBlock] = []
+        self._index: Dict[Tuple[int, str], List[int]] = {}
+
+    def __getstate__(self):
+        """Caches are not pickled. Weak references cannot be"""
+        state = self.__dict__.copy()
+        state["_last_dataset"] = None
+        state["_last_keys"] = frozenset()
+        state["_series_results"] = OrderedDict()
+        return state
+
+    @classmethod
+    def from_json(cls, path: Union[str, Path], **kwargs) -> "SafePrivateDefinition":
+        """Load a catalogue of safe private blocks from a JSON file
+
+        The file should contain a list of blocks like::
+
+            [{"tags": ["0019,[SIEMENS MR HEADER]08", "0019,[SIEMENS MR HEADER]09"],
+              "criterion": "Modality.equals('MR')",
+              "comment": "Sequence parameters, no PII",
+              "series_level": true}]
+
+        Only "tags" is required. Criterion is a dicomcriterion expression.
+
+        Parameters
+        ----------
+        path: str or Path
+            Path to JSON file
+        kwargs
+            Passed to SafePrivateDefinition init
+
+        Raises
+        ------
+        SafePrivateError
+            If the file cannot be parsed as a catalogue
+        """
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            blocks = [
+                SafePrivateBlock(
+                    tags=entry["tags"],
+                    criterion=entry.get("criterion") or None,
+                    comment=entry.get("comment", ""),
+                    series_level=bool(entry.get("series_level", False)),
+                )
+                for entry in entries
+            ]
+        except (KeyError, TypeError, ValueError, CriterionError) as e:
+            raise SafePrivateError(f"Could not read catalogue {path}: {e}") from e
+        return cls(blocks=blocks, **kwargs)
+
+    @classmethod
+    def from_csv(cls, path: Union[str, Path], **kwargs) -> "SafePrivateDefinition":
+        """Load a catalogue of safe private tags from a CSV file
+
+        The file should have a header row with columns 'tag', and optionally
+        'criterion', 'comment' and 'series_level'. There is one row per tag. Tags
+        with the same criterion, comment and series_level are put in the same
+        block::
+
+            tag,criterion,comment,series_level
+            "0019,[SIEMENS MR HEADER]08",Modality.equals('MR'),Sequence info,true
+            "0019,[SIEMENS MR HEADER]09",Modality.equals('MR'),Sequence info,true
+
+        Parameters
+        ----------
+        path: str or Path
+            Path to CSV file
+        kwargs
+            Passed to SafePrivateDefinition init
+
+        Raises
+        ------
+        SafePrivateError
+            If the file cannot be parsed as a catalogue
+        """
+        grouped: Dict[Tuple[str, str, bool], List[str]] = {}
+        try:
+            with open(path, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    key = (
+                        (row.get("criterion") or "").strip(),
+                        (row.get("comment") or "").strip(),
+                        (row.get("series_level") or "").strip().lower()
+                        in ("1", "true", "yes"),
+                    )
+                    grouped.setdefault(key, []).append(row["tag"].strip())
+            blocks = [
+                SafePrivateBlock(
+                    tags=tags,
+                    criterion=criterion or None,
+                    comment=comment,
+                    series_level=series_level,
+                )
+                for (criterion, comment, series_level), tags in grouped.items()
+            ]
+        except (KeyError, AttributeError, ValueError, CriterionError) as e:
+            raise SafePrivateError(f"Could not read catalogue {path}: {e}") from e
+        return cls(blocks=blocks, **kwargs)
+
+    def clear_cache(self):
+        """Forget all remembered results"""
+        self._last_dataset = None
+        self._last_keys = frozenset()
+        self._series_results.clear()
 
     def is_safe(self, element: DataElement, dataset: Dataset) -> bool:
         """True if the given private element in the given dataset is safe to keep
@@ -109,7 +350,36 @@ class SafePrivateDefinition:
         SafePrivateError
             If for some reason it cannot be determined whether this is safe
         """
-        return any(x.matches(element) for x in self.safe_identifiers(dataset))
+        tag = element.tag
+        creator = getattr(element, "private_creator", None)  # None if raw
+        if creator is None:
+            creator = private_creator_of(dataset, tag)
+        key = (tag.group, creator, tag.element & 0x00FF)
+        return key in self.safe_keys(dataset)
+
+    def safe_keys(self, dataset: Dataset) -> FrozenSet[Tuple[int, str, int]]:
+        """(group, private creator, element byte) for each private tag that is safe
+        to keep given this dataset. From cache if possible
+
+        Raises
+        ------
+        SafePrivateError
+            If safe tags cannot be determined
+        """
+        if self._last_dataset is not None and self._last_dataset() is dataset:
+            return self._last_keys
+
+        series_uid = dataset.get("SeriesInstanceUID")
+        keys: Set[Tuple[int, str, int]] = set()
+        try:
+            for block in self.blocks_for(dataset):
+                if self.block_is_safe(block, dataset, series_uid):
+                    keys.update(block.keys())
+        except CriterionException as e:
+            raise SafePrivateError(e) from e
+
+        self._last_dataset, self._last_keys = weakref.ref(dataset), frozenset(keys)
+        return self._last_keys
 
     def safe_identifiers(self, dataset: Dataset) -> List[TagIdentifier]:
         """All tags that are safe to keep given this dataset
@@ -132,3 +402,50 @@ class SafePrivateDefinition:
             )
         except CriterionException as e:
             raise SafePrivateError(e) from e
+
+    def index(self) -> Dict[Tuple[int, str], List[int]]:
+        """(group, private creator) -> position of each block with tags for it
+
+        Rebuilt only when blocks have changed
+        """
+        if self._indexed_blocks != self.blocks:
+            index: Dict[Tuple[int, str], List[int]] = {}
+            for position, block in enumerate(self.blocks):
+                for group, creator in {
+                    (x.group, x.private_creator) for x in block.tags
+                }:
+                    index.setdefault((group, creator), []).append(position)
+            self._index, self._indexed_blocks = index, list(self.blocks)
+        return self._index
+
+    def blocks_for(self, dataset: Dataset) -> List[SafePrivateBlock]:
+        """All blocks with tags for any private creator in dataset, in order"""
+        index = self.index()
+        positions: Set[int] = set()
+        for (group, _), creator in PrivateBlockIndex(dataset).creators.items():
+            positions.update(index.get((group, creator), []))
+        return [self.blocks[x] for x in sorted(positions)]
+
+    def block_is_safe(
+        self, block: SafePrivateBlock, dataset: Dataset, series_uid: Optional[str]
+    ) -> bool:
+        """Check block criterion, or get the result for this series from cache
+
+        Raises
+        ------
+        CriterionException
+            If no True or False response can be given for this dataset
+        """
+        if not (series_uid and block.series_level and block.criterion):
+            return block.tags_are_safe(dataset)
+
+        results = self._series_results.get(series_uid)
+        if results is None:
+            results = self._series_results[series_uid] = {}
+            if len(self._series_results) > self.max_series:
+                self._series_results.popitem(last=False)
+        else:
+            self._series_results.move_to_end(series_uid)
+        if block not in results:
+            results[block] = block.tags_are_safe(dataset)
+        return results[block]
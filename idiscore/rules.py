@@ -1,10 +1,17 @@
-from typing import Dict, Iterable, Optional, Set, Union
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
 
 from pydicom.dataelem import DataElement
-from pydicom.tag import BaseTag
+from pydicom.dataset import Dataset
+from pydicom.tag import BaseTag, Tag
 
-from idiscore.identifiers import SingleTag, TagIdentifier
-from idiscore.operators import Operator
+from idiscore.identifiers import PrivateBlockTagIdentifier, SingleTag, TagIdentifier
+from idiscore.operators import Operator, Remove
+from idiscore.private_processing import PrivateBlockIndex
+
+# A wildcard rule with its position in the specific-to-general order, and its
+# pre-computed bit mask and value: (index, mask, value, exact_mask, rule)
+IndexedRule = Tuple[int, int, int, bool, "Rule"]
 
 
 class Rule:
@@ -50,17 +57,59 @@ class RuleSet:
             Human readable name. Defaults to 'RuleSet'
         """
 
-        # keep single tag rules separately for more efficient matching
-        self._single_tag_rules_dict = {
-            x.identifier.key().lower(): x for x in rules if self.is_single_tag_rule(x)
+        rules = list(rules)  # allow iterating more than once
+        # keep single tag rules separately for more efficient matching. Keyed on
+        # the integer value of the tag
+        single_tag_rules = ((self.single_tag_key(x), x) for x in rules)
+        self._single_tag_rules_dict: Dict[int, Rule] = {
+            key: x for key, x in single_tag_rules if key is not None
         }
 
         # wildcard rules
         self._group_rules = [x for x in rules if not self.is_single_tag_rule(x)]
         # match most specific group rules first
         self._group_rules.sort(key=lambda x: x.number_of_matchable_tags())
+        self._index_group_rules()
 
         self.name = name
+        # Incremented on each change. Lets caches of flattened rules detect changes
+        self.revision = 0
+
+    def _index_group_rules(self):
+        """Bucket wildcard rules so that get_rule() does not need to try them all
+
+        * PrivateBlockTagIdentifier rules are keyed on (group, creator, element)
+        * Rules with a fixed group like (0010,xx10) are bucketed per group
+        * All other rules, like (50xx,xxxx) or PrivateTags() are kept in a
+          single list
+
+        Each rule is stored with its position in _group_rules, so that
+        specific-to-general order can be maintained across buckets
+        """
+        self._private_block_rules: Dict[Tuple[int, str, int], Tuple[int, Rule]] = {}
+        # same rules by (group, element) only, for when creator is not known
+        self._private_block_rules_any_creator: Dict[Tuple[int, int], List[Rule]] = {}
+        self._wildcards_per_group: Dict[int, List[IndexedRule]] = {}
+        self._open_wildcards: List[IndexedRule] = []
+        for index, rule in enumerate(self._group_rules):
+            identifier = rule.identifier
+            if isinstance(identifier, PrivateBlockTagIdentifier):
+                key = (
+                    identifier.group,
+                    identifier.private_creator,
+                    identifier.element,
+                )
+                self._private_block_rules.setdefault(key, (index, rule))
+                self._private_block_rules_any_creator.setdefault(
+                    (identifier.group, identifier.element), []
+                ).append(rule)
+                continue
+            mask, value = identifier.mask_and_value()
+            indexed = (index, mask, value, identifier.exact_mask, rule)
+            if mask & 0xFFFF0000 == 0xFFFF0000:  # group is fixed
+                self._wildcards_per_group.setdefault(value >> 16, []).append(indexed)
+            else:
+                self._open_wildcards.append(indexed)
 
     @property
     def rules(self) -> Set[Rule]:
@@ -80,19 +129,41 @@ class RuleSet:
         """
         if rule in self._group_rules:
             self._group_rules.remove(rule)
-        elif (key := rule.identifier.key()) in self._single_tag_rules_dict:
+            self._index_group_rules()
+        elif (
+            key := self.single_tag_key(rule)
+        ) is not None and key in self._single_tag_rules_dict:
             self._single_tag_rules_dict.pop(key)
         else:
             raise KeyError(f"{rule} is not in this RuleSet")
+        self.revision += 1
 
     @staticmethod
     def is_single_tag_rule(rule: Rule) -> bool:
         """Targets only a single DICOM tag"""
         return isinstance(rule.identifier, SingleTag)
 
-    def get_rule(self, element: DataElement) -> Optional[Rule]:
+    @staticmethod
+    def single_tag_key(rule: Rule) -> Optional[int]:
+        """Integer value of the tag that rule targets, if it is a single tag rule"""
+        identifier = rule.identifier
+        return int(identifier.tag) if isinstance(identifier, SingleTag) else None
+
+    def get_rule(
+        self, element: DataElement, private_creator: Optional[str] = None
+    ) -> Optional[Rule]:
         """The most specific rule for the given DICOM element, or None if not found
 
+        Parameters
+        ----------
+        element: DataElement or RawDataElement
+            Find rule for this element. Only the tag is used, unless a wildcard
+            identifier needs to inspect the element
+        private_creator: str, optional
+            The private creator of element, for example from a PrivateBlockIndex.
+            Defaults to None, in which case element.private_creator is used. This
+            is only set for elements that have been accessed through their dataset
+
         Returns
         -------
         Rule
@@ -113,18 +184,55 @@ class RuleSet:
         Generality is determined by the `number_of_matchable_tags()` function
         of each rule. The more tags that could be matched, the more general
         the rule is
+
+        Single tags are looked up by integer tag value. Wildcard rules are
+        pre-selected using bit masks per group, so that not all wildcard rules
+        have to be tried for each element
         """
+        tag = element.tag
         # On single tags we can do efficient dictionary lookup
-        if rule := self._single_tag_rules_dict.get(self.tag_to_key(element.tag)):
+        if rule := self._single_tag_rules_dict.get(tag):
             return rule
 
-        #  found no specific rule for this tag. Try wildcard tags
-        for group_rule in self._group_rules:
-            if group_rule.matches(element):
-                return group_rule
-
-        # nothing matches. There is no rule
-        return None
+        #  found no specific rule for this tag. Try wildcard tags, keeping track
+        #  of the most specific match so far
+        best_index, best = len(self._group_rules), None
+        if self._private_block_rules and tag & 0x00010000:  # private tag
+            private_creator = private_creator or getattr(
+                element, "private_creator", None
+            )
+            if private_creator and (
+                found := self._private_block_rules.get(
+                    (tag >> 16, private_creator, tag & 0x000000FF)
+                )
+            ):
+                best_index, best = found
+
+        for candidates in (
+            self._wildcards_per_group.get(tag >> 16, ()),
+            self._open_wildcards,
+        ):
+            for index, mask, value, exact, group_rule in candidates:
+                if index >= best_index:
+                    break  # anything from here on is less specific
+                if tag & mask == value and (exact or group_rule.matches(element)):
+                    best_index, best = index, group_rule
+                    break
+
+        return best
+
+    def private_block_rules_for(self, tag: int) -> List[Rule]:
+        """All private block rules that could match tag, for any private creator"""
+        return self._private_block_rules_any_creator.get((tag >> 16, tag & 0x00FF), [])
+
+    def removes_unconditionally(self, tag: int) -> bool:
+        """True if any element with this tag would be removed, regardless of its
+        value, its private creator or the dataset it is in
+
+        Private creators are never removed unconditionally, see
+        Core.apply_private_creator_mutations()
+        """
+        return removes_unconditionally(self, tag)
 
     @staticmethod
     def tag_to_key(tag: BaseTag) -> str:
@@ -140,3 +248,182 @@ class RuleSet:
 
     def __str__(self):
         return f'RuleSet "{self.name}"'
+
+
+class RuleSetOverlay:
+    """A small RuleSet layered on top of a larger base RuleSet
+
+    Behaves as if both were flattened into a single RuleSet, with rules in overlay
+    taking precedence over rules for the same identifier in base. Avoids having to
+    rebuild the (large) base RuleSet for small, one-time additions such as
+    dataset-specific safe private rules.
+    """
+
+    def __init__(self, base: RuleSet, overlay: RuleSet, name: str = "overlay"):
+        """
+
+        Parameters
+        ----------
+        base: RuleSet
+            The rules to fall back on
+        overlay: RuleSet
+            Rules that overrule rules in base for the same identifier
+        name: str, optional
+            Human readable name. Defaults to 'overlay'
+        """
+        self.base = base
+        self.overlay = overlay
+        self.name = name
+
+    @property
+    def revision(self) -> int:
+        """Changes whenever base or overlay changes"""
+        return self.base.revision + self.overlay.revision
+
+    @property
+    def rules(self) -> Set[Rule]:
+        """All rules in this overlay, one per identifier"""
+        return set(self.as_dict().values())
+
+    def as_dict(self) -> Dict[TagIdentifier, Rule]:
+        return self.base.as_dict() | self.overlay.as_dict()
+
+    def get_rule(
+        self, element: DataElement, private_creator: Optional[str] = None
+    ) -> Optional[Rule]:
+        """The most specific rule for the given DICOM element, or None if not found
+
+        Specificity is determined as in RuleSet.get_rule(). If base and overlay
+        contain rules that are equally specific, the overlay rule is returned
+        """
+        top = self.overlay.get_rule(element, private_creator)
+        bottom = self.base.get_rule(element, private_creator)
+        if top is None:
+            return bottom
+        elif bottom is None:
+            return top
+        elif top.number_of_matchable_tags() <= bottom.number_of_matchable_tags():
+            return top
+        else:
+            return bottom
+
+    def private_block_rules_for(self, tag: int) -> List[Rule]:
+        """All private block rules that could match tag, for any private creator"""
+        overlay = self.overlay.private_block_rules_for(tag)
+        return overlay + self.base.private_block_rules_for(tag)
+
+    def removes_unconditionally(self, tag: int) -> bool:
+        """True if any element with this tag would be removed, see
+        RuleSet.removes_unconditionally()
+        """
+        return removes_unconditionally(self, tag)
+
+    def as_human_readable_list(self) -> str:
+        """All rules in this set sorted by tag name"""
+        return "\n".join(sorted(x.as_human_readable() for x in self.rules))
+
+    def __str__(self):
+        return f'RuleSetOverlay "{self.name}"'
+
+
+def removes_unconditionally(rules: Union[RuleSet, RuleSetOverlay], tag: int) -> bool:
+    """True if rules would remove any element with this tag, regardless of its
+    value, its private creator or the dataset it is in
+    """
+    tag = Tag(tag)
+    if tag.is_private_creator:
+        return False  # only removed if their block is empty
+    rule = rules.get_rule(DataElement(tag, "UN", None))
+    if not (rule and isinstance(rule.operation, Remove)):
+        return False
+    if tag.is_private:  # a private block rule could overrule for some creators
+        return all(
+            isinstance(x.operation, Remove) for x in rules.private_block_rules_for(tag)
+        )
+    return True
+
+
+# The rule for each element in a dataset, in tag order. None means no rule
+RulePlan = List[Tuple[BaseTag, Optional[Rule]]]
+
+
+class RulePlanCache:
+    """Remembers which rule applies to each element of a dataset
+
+    Datasets in the same series tend to have exactly the same tags. Resolving a
+    rule for each element has to be done only once for all of these.
+
+    Plans are keyed on the rule set and the dataset signature: all tags in the
+    dataset plus the values of any private creator elements. This assumes that
+    which rule applies to an element depends only on the element tag and its
+    private creator, which holds for all TagIdentifiers in idiscore.
+
+    Least recently used plans are discarded when max_size is exceeded
+    """
+
+    def __init__(self, max_size: int = 256):
+        """
+
+        Parameters
+        ----------
+        max_size: int, optional
+            Maximum number of plans to keep. Defaults to 256
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._plans: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get_plan(
+        self, rules: Union[RuleSet, RuleSetOverlay], dataset: Dataset
+    ) -> RulePlan:
+        """The rule for each element in dataset, from cache if possible"""
+        index = PrivateBlockIndex(dataset)
+        key = (rules, rules.revision, self.signature(dataset, index))
+        plan = self._plans.get(key)
+        if plan is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return plan
+
+        self.misses += 1
+        plan = []
+        for tag in sorted(dataset.keys()):  # raw elements, no need to convert
+            element = dataset.get_item(tag, keep_deferred=True)
+            creator = index.creator(tag) if tag.is_private else None
+            plan.append((tag, rules.get_rule(element, creator)))
+        self._plans[key] = plan
+        if len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
+        return plan
+
+    @staticmethod
+    def signature(
+        dataset: Dataset, index: Optional[PrivateBlockIndex] = None
+    ) -> Tuple[FrozenSet, FrozenSet]:
+        """All tags in this dataset, and the value of each private creator
+
+        Parameters
+        ----------
+        dataset: Dataset
+            Get signature for this dataset
+        index: PrivateBlockIndex, optional
+            Private creators of dataset. Defaults to None, in which case this is
+            built from dataset
+        """
+        if index is None:
+            index = PrivateBlockIndex(dataset)
+        return frozenset(dataset.keys()), frozenset(index.creators.items())
+
+    def clear(self):
+        """Remove all plans and reset counters"""
+        self._plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Number of hits, misses and plans currently cached"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
@@ -0,0 +1,398 @@
+"""Finding out which bouncers would reject which files, for many files at once
+
+Meant for surveying large archives before deidentifying them. Header values are
+read once into a HeaderTable, with one column per DICOM keyword. Each bouncer is
+then evaluated over whole columns instead of dataset by dataset.
+
+Columns are dictionary-encoded: each distinct value is stored once, and each row
+holds the index of its value. Bouncers look at each distinct value only once, so
+a column of ten million rows with fifty distinct SOPClassUIDs costs fifty checks
+plus one vectorized pass over the indices.
+
+Requires numpy, like pixel data cleaning does. Install with
+`pip install idiscore[numpy]`
+"""
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from dicomcriterion import DicomSymbol, EvaluationError
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import (
+    ColorSoftcopyPresentationStateStorage,
+    EncapsulatedCDAStorage,
+    EncapsulatedPDFStorage,
+    GrayscaleSoftcopyPresentationStateStorage,
+    KeyObjectSelectionDocumentStorage,
+)
+
+from idiscore.batch import PathLike
+from idiscore.bouncers import (
+    SYMBOL_PATTERN,
+    Bouncer,
+    BouncerError,
+    CriterionBouncer,
+    DatasetRejected,
+    RejectEncapsulatedImageStorage,
+    RejectKOGSPS,
+    RejectNonStandardDicom,
+    equals_arguments,
+    equals_key,
+)
+from idiscore.file_io import read_header
+
+MISSING = -1  # code for 'element not in dataset'
+
+
+class HeaderColumn:
+    """Values of one DICOM element for all rows of a HeaderTable"""
+
+    def __init__(self, codes: np.ndarray, values: List[Any]):
+        """
+
+        Parameters
+        ----------
+        codes: np.ndarray
+            For each row, the index of its value in values. MISSING if the element
+            was not in the dataset
+        values: List[Any]
+            Distinct values
+        """
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def present(self) -> np.ndarray:
+        """Mask of rows that have this element"""
+        return self.codes != MISSING
+
+    def where(self, predicate: Callable[[Any], bool]) -> np.ndarray:
+        """Mask of rows whose value satisfies predicate
+
+        predicate is called once for each distinct value. Rows without this
+        element are never selected
+        """
+        matching = [code for code, value in enumerate(self.values) if predicate(value)]
+        return np.isin(self.codes, matching)
+
+
+class HeaderTable:
+    """Header values of many DICOM datasets, one column per DICOM keyword
+
+    Example
+    -------
+    >>> table = HeaderTable.from_paths(paths, triage_keywords(bouncers))
+    >>> result = triage(bouncers, table)
+    >>> result.counts()
+    """
+
+    def __init__(
+        self,
+        columns: Dict[str, HeaderColumn],
+        length: int,
+        unreadable: Optional[np.ndarray] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        columns: Dict[str, HeaderColumn]
+            Column for each DICOM keyword
+        length: int
+            Number of rows
+        unreadable: np.ndarray, optional
+            Mask of rows that could not be read. These have no values. Defaults
+            to None, meaning all rows were read
+        """
+        self.columns = columns
+        self.length = length
+        if unreadable is None:
+            unreadable = np.zeros(length, dtype=bool)
+        self.unreadable = unreadable
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, keyword: str):
+        return keyword in self.columns
+
+    def __getitem__(self, keyword: str) -> HeaderColumn:
+        """Column for keyword. An all-missing column if the table has none"""
+        try:
+            return self.columns[keyword]
+        except KeyError:
+            return HeaderColumn(np.full(self.length, MISSING, dtype=np.int32), [])
+
+    @classmethod
+    def from_datasets(
+        cls, datasets: Iterable[Optional[Dataset]], keywords: Sequence[str]
+    ) -> "HeaderTable":
+        """Table with the value of each keyword for each dataset, in order
+
+        A None instead of a dataset is recorded as an unreadable row
+        """
+        codes: Dict[str, List[int]] = {x: [] for x in keywords}
+        values: Dict[str, List[Any]] = {x: [] for x in keywords}
+        lookups: Dict[str, Dict[Any, int]] = {x: {} for x in keywords}
+        unreadable: List[bool] = []
+        missing = object()
+        length = 0
+        for dataset in datasets:
+            length += 1
+            unreadable.append(dataset is None)
+            for keyword in keywords:
+                if dataset is None:
+                    codes[keyword].append(MISSING)
+                    continue
+                value = dataset.get(keyword, missing)
+                if value is missing:
+                    codes[keyword].append(MISSING)
+                    continue
+                key = tuple(value) if isinstance(value, list) else value
+                try:
+                    code = lookups[keyword].setdefault(key, len(values[keyword]))
+                except TypeError:  # unhashable, like a sequence. Store each
+                    code = len(values[keyword])
+                if code == len(values[keyword]):
+                    values[keyword].append(value)
+                codes[keyword].append(code)
+
+        return cls(
+            columns={
+                x: HeaderColumn(np.array(codes[x], dtype=np.int32), values[x])
+                for x in keywords
+            },
+            length=length,
+            unreadable=np.array(unreadable, dtype=bool),
+        )
+
+    @classmethod
+    def from_paths(
+        cls, paths: Iterable[PathLike], keywords: Sequence[str]
+    ) -> "HeaderTable":
+        """Table with the value of each keyword in each DICOM file, in order
+
+        Only the elements needed are read from each file, see read_header().
+        Files that cannot be read, or are not valid DICOM, are recorded as
+        unreadable rows
+        """
+        return cls.from_datasets(
+            (read_header_or_none(x, keywords) for x in paths), keywords
+        )
+
+    def row(self, index: int, keywords: Iterable[str]) -> Dataset:
+        """Dataset with the values of keywords in row index"""
+        dataset = Dataset()
+        for keyword in keywords:
+            column = self[keyword]
+            code = column.codes[index]
+            if code != MISSING:
+                setattr(dataset, keyword, column.values[code])
+        return dataset
+
+
+def read_header_or_none(path: PathLike, keywords: Sequence[str]) -> Optional[Dataset]:
+    """Like read_header(), but None if path cannot be read or is not valid DICOM"""
+    try:
+        return read_header(path, keywords)
+    except (InvalidDicomError, OSError):
+        return None
+
+
+class TriageResult:
+    """Which bouncers reject which rows of a HeaderTable"""
+
+    def __init__(
+        self, bouncers: List[Bouncer], rejected: np.ndarray, errors: np.ndarray
+    ):
+        """
+
+        Parameters
+        ----------
+        bouncers: List[Bouncer]
+            The bouncers that were evaluated
+        rejected: np.ndarray
+            Boolean array of shape (bouncers, rows). True where bouncer rejects row
+        errors: np.ndarray
+            Boolean array of shape (bouncers, rows). True where bouncer cannot
+            determine its answer for row
+        """
+        self.bouncers = bouncers
+        self.rejected = rejected
+        self.errors = errors
+
+    def counts(self) -> Dict[Bouncer, int]:
+        """Number of rows each bouncer rejects, regardless of other bouncers"""
+        return {
+            bouncer: int(count)
+            for bouncer, count in zip(
+                self.bouncers, self.rejected.sum(axis=1), strict=True
+            )
+        }
+
+    def stopped_by(self) -> np.ndarray:
+        """For each row, index of the bouncer that would stop it. -1 if none would
+
+        Bouncers are run in list order, and the first one that rejects a dataset or
+        cannot determine its answer stops it
+        """
+        stopped = self.rejected | self.errors
+        if not self.bouncers:
+            return np.full(stopped.shape[1], -1)
+        first = np.argmax(stopped, axis=0)
+        return np.where(stopped.any(axis=0), first, -1)
+
+    @property
+    def accepted(self) -> np.ndarray:
+        """Mask of rows that no bouncer would stop"""
+        return ~(self.rejected | self.errors).any(axis=0)
+
+
+def criterion_keywords(expression: str) -> List[str]:
+    """DICOM keywords of all attributes in a dicomcriterion expression"""
+    keywords = [
+        DicomSymbol.parse(x).attribute for x in re.findall(SYMBOL_PATTERN, expression)
+    ]
+    return list(dict.fromkeys(keywords))
+
+
+def bouncer_keywords(bouncer: Bouncer) -> Optional[List[str]]:
+    """DICOM keywords of all elements that bouncer looks at. None if unknown"""
+    if bouncer.required_tags is not None:
+        return bouncer.required_tags
+    if isinstance(bouncer, CriterionBouncer) and bouncer.expression:
+        return criterion_keywords(bouncer.expression)
+    return None
+
+
+def triage_keywords(bouncers: List[Bouncer]) -> List[str]:
+    """DICOM keywords of all elements that triage() needs for bouncers
+
+    Raises
+    ------
+    ValueError
+        If it is not known which elements a bouncer looks at
+    """
+    keywords: Dict[str, None] = {}
+    for bouncer in bouncers:
+        found = bouncer_keywords(bouncer)
+        if found is None:
+            raise ValueError(
+                f"Cannot triage {bouncer.description}. It does not declare"
+                f" required_tags"
+            )
+        keywords.update(dict.fromkeys(found))
+    return list(keywords)
+
+
+def triage(bouncers: List[Bouncer], table: HeaderTable) -> TriageResult:
+    """Determine for each bouncer which rows of table it rejects
+
+    CriterionBouncers with expressions like "Modality.equals('CT') or
+    Modality.equals('MR')" and the SOPClassUID bouncers from idiscore.bouncers are
+    evaluated column by column. Other bouncers are run on a dataset made from
+    each distinct combination of the values they look at.
+
+    Rows are judged as read, before any pixel data cleaning. A bouncer that would
+    only let a dataset through after cleaning, rejects it here. Unreadable rows
+    are errors for every bouncer.
+
+    Raises
+    ------
+    ValueError
+        If it is not known which elements a bouncer looks at
+    """
+    rejected = np.zeros((len(bouncers), len(table)), dtype=bool)
+    errors = np.zeros((len(bouncers), len(table)), dtype=bool)
+    for index, bouncer in enumerate(bouncers):
+        rejected[index], errors[index] = triage_bouncer(bouncer, table)
+    rejected[:, table.unreadable] = False
+    errors[:, table.unreadable] = True
+    return TriageResult(bouncers=bouncers, rejected=rejected, errors=errors)
+
+
+def triage_bouncer(bouncer: Bouncer, table: HeaderTable):
+    """(rejected, errors) masks for bouncer over all rows of table"""
+    no_errors = np.zeros(len(table), dtype=bool)
+    if isinstance(bouncer, CriterionBouncer):
+        arguments = equals_arguments(bouncer.expression or "")
+        if arguments is not None:
+            return triage_equals(arguments, table), no_errors
+
+    sop_class = table["SOPClassUID"]
+    if type(bouncer) is RejectNonStandardDicom:
+        rejected = sop_class.where(lambda x: not str(x).startswith("1.2.840.10008"))
+        return rejected, ~sop_class.present
+    if type(bouncer) is RejectEncapsulatedImageStorage:
+        encapsulated = [EncapsulatedPDFStorage, EncapsulatedCDAStorage]
+        return sop_class.where(lambda x: x in encapsulated), ~sop_class.present
+    if type(bouncer) is RejectKOGSPS:
+        presentation = sop_class.where(
+            lambda x: x
+            in [
+                ColorSoftcopyPresentationStateStorage,
+                GrayscaleSoftcopyPresentationStateStorage,
+            ]
+        )
+        description = table["SeriesDescription"]
+        rejected = sop_class.where(
+            lambda x: x == KeyObjectSelectionDocumentStorage
+        ) | presentation & description.where(lambda x: x != "Annotation")
+        errors = ~sop_class.present | presentation & ~description.present
+        return rejected, errors
+
+    return triage_by_inspection(bouncer, table)
+
+
+def triage_equals(arguments, table: HeaderTable) -> np.ndarray:
+    """Mask of rows for which any (keyword, argument) passes equals()"""
+    matched = np.zeros(len(table), dtype=bool)
+    for keyword, argument in arguments:
+        matched |= table[keyword].where(equals_predicate(argument))
+    return matched
+
+
+def equals_predicate(argument: str) -> Callable[[Any], bool]:
+    """Function that gives the same answer as dicomcriterion's equals(argument)
+    for an element value
+    """
+    expected = argument.strip().lower()
+    nulls = argument.lower() in ("none", "null", "")
+    return lambda x: nulls if x is None else equals_key(x) == expected
+
+
+def triage_by_inspection(bouncer: Bouncer, table: HeaderTable):
+    """(rejected, errors) masks, running bouncer once per distinct combination
+    of the values it looks at
+
+    Raises
+    ------
+    ValueError
+        If it is not known which elements bouncer looks at
+    """
+    keywords = bouncer_keywords(bouncer)
+    if keywords is None:
+        raise ValueError(
+            f"Cannot triage {bouncer.description}. It does not declare required_tags"
+        )
+    codes = np.stack(
+        [table[x].codes for x in keywords] or [np.zeros(len(table), dtype=np.int32)],
+        axis=1,
+    )
+    _, rows, inverse = np.unique(codes, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    rejected = np.zeros(len(rows), dtype=bool)
+    errors = np.zeros(len(rows), dtype=bool)
+    for index, row in enumerate(rows):  # first row with each combination
+        try:
+            bouncer.inspect(table.row(int(row), keywords))
+        except DatasetRejected:
+            rejected[index] = True
+        except (BouncerError, EvaluationError):
+            errors[index] = True
+    return rejected[inverse], errors[inverse]
@@ -18,8 +18,9 @@ The validation approach is as follows:
 
 """
 from copy import deepcopy
-from typing import Dict, List
+from typing import Dict, List, TypeGuard
 
+from pydicom.dataelem import RawDataElement
 from pydicom.dataset import Dataset
 
 from idiscore.annotation import Annotation, ExampleDataset
@@ -176,9 +177,14 @@ def extract_signature(deidentifier: Deidentifier, dataset: Dataset) -> List[Delt
     after = deidentifier.deidentify(dataset=deepcopy_fix(dataset))
 
     deltas = []
-    for element in dataset:  # go over all original elements to find changes
-        tag = element.tag
-        val_before = element.value
+    for tag in sorted(dataset.keys()):  # go over all original elements
+        element = dataset.get_item(tag, keep_deferred=True)
+        if is_unchanged_deferred(element, after.get_item(tag, keep_deferred=True)):
+            # don't load deferred values just to compare them
+            placeholder = f"<{element.length} bytes, not loaded>"
+            deltas.append(Delta(tag=tag, before=placeholder, after=placeholder))
+            continue
+        val_before = dataset[tag].value
         if tag_after := after.get(tag):
             val_after = tag_after.value
         else:
@@ -186,8 +192,17 @@ def extract_signature(deidentifier: Deidentifier, dataset: Dataset) -> List[Delt
         deltas.append(Delta(tag=tag, before=val_before, after=val_after))
 
     # find tags that might have been inserted
-    inserted_tags = {x.tag for x in after} - {x.tag for x in dataset}
+    inserted_tags = set(after.keys()) - set(dataset.keys())
     for tag in inserted_tags:
         deltas.append(Delta(tag=tag, before=None, after=after[tag]))
 
     return deltas
+
+
+def is_unchanged_deferred(before, after) -> TypeGuard[RawDataElement]:
+    """True if both are the same raw element, with a value that was deferred
+    when reading and has not been loaded
+    """
+    return (
+        isinstance(before, RawDataElement) and before.value is None and before == after
+    )
@@ -0,0 +1,96 @@
+import pytest
+from pydicom import dcmread
+
+from idiscore.batch import BatchStatus, deidentify_many, process_item
+from idiscore.bouncers import RejectNonStandardDicom
+from idiscore.core import Core
+from idiscore.defaults import create_default_core
+from tests.factories import quick_dataset
+
+
+@pytest.fixture
+def a_rejecting_core(a_core_with_some_rules) -> Core:
+    """Core with some rules that rejects non-standard SOPClassUIDs"""
+    core = a_core_with_some_rules
+    core.bouncers = [RejectNonStandardDicom()]
+    return core
+
+
+def test_process_item(a_rejecting_core, a_path_to_dataset, tmp_path):
+    """Success, rejection and failure are all recorded as results"""
+    core = a_rejecting_core
+
+    result = process_item(core, 0, quick_dataset(SOPClassUID="1.2.840.10008.1"))
+    assert result.succeeded
+    assert result.dataset
+
+    result = process_item(core, 1, quick_dataset(SOPClassUID="123"))
+    assert result.status == BatchStatus.REJECTED
+    assert "non-standard" in result.message
+
+    not_dicom = tmp_path / "not_dicom.txt"
+    not_dicom.write_text("not a dicom file")
+    result = process_item(core, 2, not_dicom)
+    assert result.status == BatchStatus.FAILED
+    assert result.source == str(not_dicom)
+
+    # with an output path, results are written instead of returned
+    out = tmp_path / "out" / "deidentified.dcm"
+    core.bouncers = []
+    result = process_item(core, 3, (a_path_to_dataset, out))
+    assert result.succeeded
+    assert result.dataset is None
+    assert result.size == a_path_to_dataset.stat().st_size
+    assert dcmread(out).PatientName != "Martha"
+
+
+class FailOnName:
+    """Deidentifier that fails unexpectedly for one patient name"""
+
+    def deidentify(self, dataset):
+        if dataset.PatientName == "fail":
+            raise ValueError("Unsupported value")
+        return dataset
+
+
+def test_deidentify_many_unexpected_error():
+    """An unexpected error in one item is recorded, and does not end the batch"""
+    datasets = [quick_dataset(PatientName=x) for x in ("ok", "fail", "ok")]
+    results = list(deidentify_many(FailOnName(), datasets, max_workers=2))
+
+    assert [x.status for x in results] == [
+        BatchStatus.SUCCESS,
+        BatchStatus.FAILED,
+        BatchStatus.SUCCESS,
+    ]
+    assert results[1].message == "ValueError: Unsupported value"
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_deidentify_many(a_rejecting_core, ordered):
+    datasets = [
+        quick_dataset(SOPClassUID="1.2.840.10008.1", PatientName=f"name{x}")
+        for x in range(10)
+    ]
+    datasets[3].SOPClassUID = "123"
+
+    results = list(
+        a_rejecting_core.deidentify_many(datasets, max_workers=2, ordered=ordered)
+    )
+
+    assert len(results) == 10
+    if ordered:
+        assert [x.index for x in results] == list(range(10))
+    assert {x.index for x in results if not x.succeeded} == {3}
+    for result in (x for x in results if x.succeeded):
+        assert result.dataset.PatientName != f"name{result.index}"
+
+
+def test_deidentify_many_factory(a_path_to_dataset, tmp_path):
+    """A function creating a core can be passed instead of a core"""
+    items = [(a_path_to_dataset, tmp_path / "out" / f"{x}.dcm") for x in range(3)]
+    results = list(deidentify_many(create_default_core, items, max_workers=2))
+
+    # default core cannot determine whether a dataset without SOPClassUID is safe
+    assert {x.status for x in results} == {BatchStatus.FAILED}
+    assert "Required tag not found" in results[0].message
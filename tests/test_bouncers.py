@@ -1,17 +1,26 @@
+import pickle
+
 import pytest
 from pydicom.dataset import Dataset
+from pydicom.uid import CTImageStorage, EncapsulatedPDFStorage
 
 from idiscore.bouncers import (
+    AdaptiveBouncerOrder,
+    Bouncer,
+    BouncerDecisionCache,
     DatasetRejected,
     RejectEncapsulatedImageStorage,
     RejectKOGSPS,
     RejectNonStandardDicom,
     BouncerError,
     CriterionBouncer,
+    CriterionTable,
+    compile_bouncers,
     determine_bouncer_results,
     PatchedDataset,
 )
 from idiscore.core import Core, DeidentificationError, Profile
+from idiscore.file_io import read_header
 from tests.factories import quick_dataset
 
 
@@ -25,6 +34,10 @@ def test_reject_non_standard():
     with pytest.raises(DeidentificationError):
         a_core.deidentify(quick_dataset(SOPClassUID="123"))
 
+    # missing SOPClassUID is a bouncer error, not an AttributeError
+    with pytest.raises(DeidentificationError):
+        a_core.deidentify(quick_dataset(Modality="CT"))
+
 
 @pytest.mark.parametrize(
     "dataset",
@@ -131,3 +144,200 @@ def test_patched_dataset():
     assert dataset.Modality == "US"  # should have changed back
     assert dataset.PatientName == "name"  # should still be there
     assert patched.get("PatientID") is None  # should not exist any more
+
+
+@pytest.mark.parametrize(
+    "sop_class_uid, rejected",
+    [(EncapsulatedPDFStorage, True), ("123", True), (CTImageStorage, False)],
+)
+def test_prescreen(a_dataset, tmp_path, monkeypatch, sop_class_uid, rejected):
+    """Files can be rejected based on their header, without reading further"""
+    a_dataset.SOPClassUID = sop_class_uid
+    a_dataset.add_new("EncapsulatedDocument", "OB", bytes(4096))
+    path = tmp_path / "a_file.dcm"
+    a_dataset.save_as(path, enforce_file_format=True)
+
+    header = read_header(path, ["SOPClassUID", "SeriesDescription"])
+    assert list(header.keys()) == [0x00080016]
+
+    core = Core(
+        profile=Profile(rule_sets=[]),
+        bouncers=[RejectEncapsulatedImageStorage(), RejectNonStandardDicom()],
+    )
+    if rejected:
+        monkeypatch.setattr(core.reader, "read", None)  # should not get this far
+        with pytest.raises(DeidentificationError):
+            core.read(path)
+    else:
+        assert core.read(path).EncapsulatedDocument == bytes(4096)
+
+
+class CountingBouncer(Bouncer):
+    """Rejects nothing. Records each dataset it inspects"""
+
+    def __init__(self, required_tags=None):
+        self.required_tags = required_tags
+        self.inspected = []
+
+    def inspect(self, dataset):
+        self.inspected.append(dataset.get("BurnedInAnnotation"))
+
+
+def test_bouncer_results_burned_in_annotation():
+    """Only bouncers that might depend on BurnedInAnnotation are run twice"""
+    independent = CountingBouncer(required_tags=["Modality"])
+    dependent = CountingBouncer(required_tags=["Modality", "BurnedInAnnotation"])
+    unknown = CountingBouncer()
+    dataset = quick_dataset(Modality="US", BurnedInAnnotation="YES")
+
+    assert not determine_bouncer_results([independent, dependent, unknown], dataset)
+    assert len(independent.inspected) == 1
+    assert dependent.inspected == ["NO", "YES"]
+    assert unknown.inspected == ["NO", "YES"]
+    assert dataset.BurnedInAnnotation == "YES"  # never changed
+
+
+class RejectUltrasound(CountingBouncer):
+    """Rejects ultrasound. Records each dataset it inspects"""
+
+    def inspect(self, dataset):
+        super().inspect(dataset)
+        if dataset.Modality == "US":
+            raise DatasetRejected(f"No US please ({dataset.SeriesInstanceUID})")
+
+
+def test_bouncer_decision_cache():
+    """Decisions are re-used for datasets with the same inspected values"""
+    cache = BouncerDecisionCache(max_size=2)
+    bouncer = RejectUltrasound(required_tags=["Modality"])
+    for _ in range(3):
+        cache.inspect(bouncer, quick_dataset(Modality="CT"))
+    assert len(bouncer.inspected) == 1
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 1}
+
+    # rejections are remembered, including the message
+    for series in ("1", "2"):
+        with pytest.raises(DatasetRejected, match=r"\(1\)"):
+            cache.inspect(
+                bouncer, quick_dataset(Modality="US", SeriesInstanceUID=series)
+            )
+    assert len(bouncer.inspected) == 2
+
+    # no declared tags, no caching
+    unknown = RejectUltrasound()
+    for _ in range(2):
+        cache.inspect(unknown, quick_dataset(Modality="CT"))
+    assert len(unknown.inspected) == 2
+
+    # series level bouncers are keyed on series
+    series_level = RejectUltrasound()
+    series_level.series_level = True
+    for series in ("1", "1", "2"):
+        cache.inspect(
+            series_level, quick_dataset(Modality="CT", SeriesInstanceUID=series)
+        )
+    assert len(series_level.inspected) == 2
+    assert len(cache) == 2  # max size
+
+    copied = pickle.loads(pickle.dumps(cache))
+    assert len(copied) == 0
+    copied.inspect(bouncer, quick_dataset(Modality="CT"))
+
+
+class RejectBurnedIn(Bouncer):
+    """Series level bouncer that rejects burned in annotations"""
+
+    series_level = True
+
+    def inspect(self, dataset):
+        if dataset.get("BurnedInAnnotation") == "YES":
+            raise DatasetRejected("Burned in annotation")
+
+
+def test_bouncer_decision_cache_burned_in_annotation():
+    """A series level decision for the cleaned case is not used for the original"""
+    bouncer = RejectBurnedIn()
+    core = Core(Profile([]), bouncers=[bouncer])
+    dataset = quick_dataset(BurnedInAnnotation="YES", SeriesInstanceUID="1")
+    maybe_allow = determine_bouncer_results(
+        [bouncer], dataset, core.bouncer_cache, core.bouncer_order
+    )
+    assert maybe_allow == [bouncer]
+
+    # no pixel processor can clean this, so it is rejected
+    with pytest.raises(DeidentificationError):
+        core.deidentify(dataset)
+
+
+class SlowBouncer(Bouncer):
+    """Takes its time to accept everything"""
+
+    def inspect(self, dataset):
+        sum(range(50000))
+
+
+class RejectEverything(Bouncer):
+    def __init__(self, name):
+        self.name = name
+
+    def inspect(self, dataset):
+        raise DatasetRejected(f"Rejected by {self.name}")
+
+
+def test_adaptive_bouncer_order():
+    """Cheap bouncers that often reject go first, without changing the outcome"""
+    order = AdaptiveBouncerOrder()
+    slow, first, second = SlowBouncer(), RejectEverything("1"), RejectEverything("2")
+    bouncers = [slow, first, second]
+    dataset = quick_dataset(Modality="CT")
+
+    for _ in range(5):
+        # Always the rejection of the first rejecting bouncer in the list
+        with pytest.raises(DatasetRejected, match="Rejected by 1"):
+            order.run(bouncers, lambda x: x.inspect(dataset))
+    assert order.order(bouncers)[-1] == 0  # slow one last
+    assert order.stats()[first]["rejection_rate"] == 1
+
+    core = Core(Profile([]), bouncers=bouncers, bouncer_order=order)
+    with pytest.raises(DeidentificationError) as e:
+        core.deidentify(dataset)
+    assert str(e.value.__cause__) == "Rejected by 1"
+
+
+def test_compile_bouncers():
+    """Simple criterion bouncers are decided by table, with the same outcome"""
+    bouncers = [
+        CriterionBouncer("Modality.equals('US') and BurnedInAnnotation.equals('YES')"),
+        CriterionBouncer("Modality.equals('CT') or Modality.equals(' mr ')", "1"),
+        SlowBouncer(),
+        CriterionBouncer("SOPClassUID.equals('1.2.3')", "2"),
+        CriterionBouncer("Modality.equals('mr') or SeriesDescription.equals('')", "3"),
+    ]
+    compiled = compile_bouncers(bouncers)
+    assert [type(x) for x in compiled] == [
+        CriterionBouncer,
+        CriterionTable,
+        SlowBouncer,
+    ]
+    assert compiled[1].required_tags == ["Modality", "SOPClassUID", "SeriesDescription"]
+
+    def outcome(bouncer_list, dataset):
+        try:
+            for bouncer in bouncer_list:
+                bouncer.inspect(dataset)
+        except DatasetRejected as e:
+            return str(e)
+
+    for dataset in [
+        quick_dataset(Modality="MR", SOPClassUID="1.2.3"),
+        quick_dataset(Modality="CT", SOPClassUID="1.2.3"),
+        quick_dataset(Modality="PT", SOPClassUID="1.2.3"),
+        quick_dataset(Modality="PT", SOPClassUID="1.2.4", SeriesDescription=""),
+        quick_dataset(Modality="PT", SOPClassUID="1.2.4", SeriesDescription="a"),
+    ]:
+        assert outcome(compiled, dataset) == outcome(bouncers, dataset)
+
+    # identical expressions are parsed once
+    assert CriterionBouncer(" SOPClassUID.equals('1.2.3')").criterion is (
+        bouncers[3].criterion
+    )
@@ -1,5 +1,8 @@
+import pytest
 from click.testing import CliRunner
 from dicomgenerator.export import export
+from pydicom import dcmread
+from pydicom.uid import CTImageStorage
 
 import idiscore.cli as cli
 from idiscore.annotation import ExampleDataset
@@ -46,3 +49,82 @@ def test_cli_to_example_temp(tmp_path, a_path_to_dataset):
     assert annotated.description == "No description"
 
     export(annotated.dataset, path=tmp_path / "test_cli_to_example_temp.dcm")
+
+
+@pytest.fixture
+def a_folder_to_deidentify(a_dataset, tmp_path):
+    """Folder with nested DICOM files, one of which is rejected, and a text file"""
+    root = tmp_path / "input"
+    a_dataset.SpecificCharacterSet = "ISO_IR 100"
+    a_dataset.SOPClassUID = CTImageStorage
+    for path in [root / "1.dcm", root / "sub" / "2.dcm"]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        a_dataset.save_as(path, enforce_file_format=True)
+    a_dataset.SOPClassUID = "123"
+    a_dataset.save_as(root / "sub" / "rejected.dcm", enforce_file_format=True)
+    (root / "sub" / "readme.txt").write_text("not a dicom file")
+    return root
+
+
+def test_cli_deidentify(a_folder_to_deidentify, tmp_path, caplog):
+    output = tmp_path / "output"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.deidentify,
+        [str(a_folder_to_deidentify), str(output), "--workers", "2"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1  # readme.txt failed
+    assert "2 deidentified, 1 rejected, 1 failed" in result.output
+    assert "files/s" in result.output
+    assert sorted(x.name for x in output.rglob("*.dcm")) == ["1.dcm", "2.dcm"]
+    assert dcmread(output / "sub" / "2.dcm").PatientIdentityRemoved == "YES"
+
+    # failures and rejections are reported per file, at default log level
+    def level_for(name):
+        path = str(a_folder_to_deidentify / "sub" / name)
+        return [x.levelname for x in caplog.records if path in x.getMessage()]
+
+    assert level_for("readme.txt") == ["ERROR"]
+    assert level_for("rejected.dcm") == ["WARNING"]
+
+
+def test_cli_deidentify_success(a_folder_to_deidentify, tmp_path):
+    """Exit status is 0 if all files are deidentified or rejected"""
+    (a_folder_to_deidentify / "sub" / "readme.txt").unlink()
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.deidentify,
+        [str(a_folder_to_deidentify), str(tmp_path / "output")],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "2 deidentified, 1 rejected, 0 failed" in result.output
+
+
+def test_cli_deidentify_custom_core(a_folder_to_deidentify, tmp_path):
+    """A core can be defined in any python file"""
+    core_file = tmp_path / "my_core.py"
+    core_file.write_text(
+        "from idiscore.core import Core, Profile\n"
+        "core = Core(profile=Profile(rule_sets=[]))\n"
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.deidentify,
+        [
+            str(a_folder_to_deidentify),
+            str(tmp_path / "output"),
+            "--core",
+            f"{core_file}:core",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 1
+    assert "3 deidentified, 0 rejected, 1 failed" in result.output
+
+
+@pytest.mark.parametrize("definition", ["no_attribute", "idiscore.defaults:"])
+def test_core_factory_exception(definition):
+    with pytest.raises(ValueError):
+        cli.CoreFactory(definition)
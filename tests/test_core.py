@@ -1,4 +1,5 @@
 """Tests for `idiscore` package."""
+import sys
 from io import BytesIO
 
 import pytest
@@ -6,23 +7,37 @@ from dicomgenerator.generators import DataElementFactory as DatEF, quick_dataset
 from pydicom import dcmread
 from pydicom.dataset import Dataset, FileMetaDataset
 from pydicom.tag import Tag
-from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian
+from pydicom.dataelem import RawDataElement
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, ImplicitVRLittleEndian
 
 from dicomgenerator.templates import CTDatasetFactory
 
 from idiscore.bouncers import CriterionBouncer
 from idiscore.core import Core, Profile
 from idiscore.defaults import create_default_core
-from idiscore.identifiers import PrivateTags, RepeatingGroup, SingleTag
+from idiscore.identifiers import (
+    PrivateBlockTagIdentifier,
+    PrivateTags,
+    RepeatingGroup,
+    SingleTag,
+)
 from idiscore.image_processing import (
     PIILocation,
     SquareArea,
     PIILocationList,
     PixelProcessor,
 )
-from idiscore.operators import Clean, Hash, Keep, Remove
+from idiscore.operators import (
+    Clean,
+    ElementShouldBeRemoved,
+    Empty,
+    Hash,
+    Keep,
+    Operator,
+    Remove,
+)
 from idiscore.private_processing import SafePrivateDefinition, SafePrivateBlock
-from idiscore.rules import Rule, RuleSet
+from idiscore.rules import Rule, RulePlanCache, RuleSet
 from idiscore.validation import extract_signature
 
 
@@ -81,6 +96,296 @@ def test_profile_flatten(some_pid_rules):
     assert hash_name in profile.flatten(additional_rule_sets=[set3]).rules
 
 
+def test_profile_compile(some_pid_rules):
+    """Compile() flattens once and re-uses the result until rule sets change"""
+    hash_name = Rule(SingleTag("PatientName"), Hash())
+    set1 = RuleSet(rules=[some_pid_rules[0], hash_name])
+    profile = Profile(rule_sets=[set1])
+
+    compiled = profile.compile()
+    assert profile.compile() is compiled  # cached
+    assert compiled.rules == profile.flatten().rules
+
+    # adding a rule set invalidates
+    profile.rule_sets.append(RuleSet(rules=[some_pid_rules[1]]))
+    assert profile.compile() is not compiled
+    assert some_pid_rules[1] in profile.compile().rules
+
+    # as does removing a rule from one of the sets
+    compiled = profile.compile()
+    set1.remove(hash_name)
+    assert profile.compile() is not compiled
+    assert hash_name not in profile.compile().rules
+
+
+def test_profile_compile_additional(some_pid_rules):
+    """Additional rule sets are overlaid on the cached rules, same as flatten()"""
+    rule_private = Rule(PrivateTags(), Remove())
+    profile = Profile(rule_sets=[RuleSet(rules=[some_pid_rules[0], rule_private])])
+    keep_private = Rule(PrivateBlockTagIdentifier("00b1[creator]01"), Keep())
+    additional = [RuleSet(rules=[some_pid_rules[2], keep_private])]
+
+    overlay = profile.compile(additional_rule_sets=additional)
+    assert overlay.rules == profile.flatten(additional_rule_sets=additional).rules
+
+    ds = Dataset()
+    block = ds.private_block(0x00B1, "creator", create=True)
+    block.add_new(0x01, "SH", "value")
+    block.add_new(0x02, "SH", "value")
+    ds.PatientID = "123"
+
+    assert overlay.get_rule(ds["PatientID"]) == some_pid_rules[2]
+    assert overlay.get_rule(block[0x01]) == keep_private  # more specific
+    assert overlay.get_rule(block[0x02]) == rule_private
+    assert profile.compile().get_rule(ds["PatientID"]) == some_pid_rules[0]
+
+
+def test_profile_compile_additional_cached(a_core_with_some_rules, some_pid_rules):
+    """The same additional rule sets give the same overlay, so that rule plans for
+    it are re-used
+    """
+    core = a_core_with_some_rules
+    additional = [RuleSet(rules=[some_pid_rules[2]])]
+    overlay = core.profile.compile(additional_rule_sets=additional)
+    assert core.profile.compile(additional_rule_sets=additional) is overlay
+
+    for _ in range(2):
+        rules = core.profile.compile(additional_rule_sets=additional)
+        core.apply_rules(rules, quick_dataset(PatientName="name", PatientID="123"))
+    assert core.plan_cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    # changing an additional rule set invalidates
+    additional[0].remove(some_pid_rules[2])
+    assert core.profile.compile(additional_rule_sets=additional) is not overlay
+
+
+def test_plan_cache(a_core_with_some_rules):
+    """Datasets with the same tags re-use the rule plan of the first"""
+
+    def get_dataset(private_creator="creator"):
+        ds = quick_dataset(PatientName="name", PatientID="123")
+        block = ds.private_block(0x00B1, private_creator, create=True)
+        block.add_new(0x01, "SH", "value")
+        return ds
+
+    core = a_core_with_some_rules
+    core.deidentify(get_dataset())
+    assert core.plan_cache.stats() == {"hits": 0, "misses": 1, "size": 1}
+
+    core.deidentify(get_dataset())  # same tags
+    assert core.plan_cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    core.deidentify(get_dataset("other_creator"))  # private block rules can differ
+    assert core.plan_cache.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+    deidentified = core.deidentify(get_dataset())  # plan re-use gives same result
+    assert deidentified.PatientName != "name"
+    assert 0x00B11001 not in deidentified
+    assert core.plan_cache.stats()["hits"] == 2
+
+
+def test_deprecated_private_block_methods():
+    """Old private block helpers still work, but warn"""
+    ds = Dataset()
+    ds.private_block(0x00B1, "other", create=True).add_new(0x01, "SH", "other")
+    block = ds.private_block(0x00B1, "creator", create=True)
+    block.add_new(0x01, "SH", "value1")
+    block.add_new(0x02, "SH", "value2")
+
+    with pytest.warns(DeprecationWarning):
+        found = Core.get_private_block_from_creator(ds, ds[0x00B10011])
+    assert found.block_start == block.block_start
+    with pytest.warns(DeprecationWarning):
+        elements = Core.get_private_elements_for_block(ds, found)
+    assert [x.value for x in elements] == ["value1", "value2"]
+
+
+def test_private_creator_removal():
+    """Private creators are only removed if their block has become empty"""
+    ds = Dataset()
+    emptied = ds.private_block(0x00B1, "emptied", create=True)
+    emptied.add_new(0x01, "SH", "value")
+    partial = ds.private_block(0x00B1, "partial", create=True)
+    partial.add_new(0x01, "SH", "value")
+    partial.add_new(0x02, "SH", "value")
+
+    keep = Rule(PrivateBlockTagIdentifier("00b1,[partial]02"), Keep())
+    core = Core(profile=Profile([RuleSet([Rule(PrivateTags(), Remove()), keep])]))
+    with pytest.warns(UserWarning, match="Not removing private creator"):
+        deidentified = core.deidentify(ds)
+
+    assert list(deidentified.keys()) == [0x00B10011, 0x00B11102]
+
+
+def test_plan_cache_max_size(a_core_with_some_rules):
+    core = Core(
+        profile=a_core_with_some_rules.profile, plan_cache=RulePlanCache(max_size=2)
+    )
+    for keyword in ["PatientID", "Modality", "StudyDescription"]:
+        core.deidentify(quick_dataset(**{keyword: "value"}))
+    assert len(core.plan_cache) == 2
+
+    # least recently used plan was discarded
+    core.deidentify(quick_dataset(PatientID="value"))
+    assert core.plan_cache.stats() == {"hits": 0, "misses": 4, "size": 2}
+
+
+def test_sequence_rules():
+    """Sequences that are removed or emptied are not recursed into"""
+
+    def a_sequence(keyword):
+        items = [quick_dataset(PatientName=keyword, PatientID=x) for x in "12"]
+        return DatEF(tag=keyword, VR="SQ", value=items)
+
+    ds = Dataset()
+    for keyword in [
+        "ReferencedStudySequence",
+        "ReferencedPatientSequence",
+        "ProcedureCodeSequence",
+    ]:
+        ds.add(a_sequence(keyword))
+
+    core = Core(
+        profile=Profile(
+            [
+                RuleSet(
+                    [
+                        Rule(SingleTag("ReferencedStudySequence"), Remove()),
+                        Rule(SingleTag("ReferencedPatientSequence"), Empty()),
+                        Rule(SingleTag("ProcedureCodeSequence"), Keep()),
+                        Rule(SingleTag("PatientName"), Remove()),
+                    ]
+                )
+            ]
+        )
+    )
+    deidentified = core.deidentify(ds)
+
+    assert "ReferencedStudySequence" not in deidentified
+    assert len(deidentified.ReferencedPatientSequence) == 0
+    kept = deidentified.ProcedureCodeSequence
+    assert len(kept) == 2
+    assert [x.get("PatientName") for x in kept] == [None, None]
+    assert [x.PatientID for x in kept] == ["1", "2"]
+
+    # Only items from the kept sequence have been visited. One plan for the
+    # top level, one for the two (identical) items in the kept sequence
+    assert core.plan_cache.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_unchanged_elements_are_left_alone():
+    """Kept elements are not replaced, emptied elements are emptied in-place"""
+    ds = quick_dataset(PatientName="name", PatientID="1234")
+    kept = ds["PatientID"]
+    emptied = ds["PatientName"]
+    core = Core(
+        profile=Profile(
+            [
+                RuleSet(
+                    [
+                        Rule(SingleTag("PatientID"), Keep()),
+                        Rule(SingleTag("PatientName"), Empty()),
+                    ]
+                )
+            ]
+        )
+    )
+    deidentified = core.deidentify(ds)
+
+    assert deidentified["PatientID"] is kept
+    assert deidentified["PatientName"] is emptied
+    assert emptied.value is None
+
+
+def test_legacy_removal_signal():
+    """Operators that raise ElementShouldBeRemoved instead of returning REMOVE
+    still work
+    """
+
+    class LegacyRemove(Operator):
+        def apply(self, element, dataset=None):
+            raise ElementShouldBeRemoved()
+
+    ds = quick_dataset(PatientName="name", PatientID="1234")
+    core = Core(
+        profile=Profile([RuleSet([Rule(SingleTag("PatientName"), LegacyRemove())])])
+    )
+    deidentified = core.deidentify(ds)
+
+    assert "PatientName" not in deidentified
+    assert deidentified.PatientID == "1234"
+
+
+@pytest.mark.parametrize(
+    "transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+)
+def test_raw_elements_are_not_converted(tmp_path, transfer_syntax):
+    """Elements whose value is not needed stay raw all the way through"""
+    ds = quick_dataset(PatientName="name", PatientID="1234", StudyID="5678")
+    ds.ReferencedImageSequence = [quick_dataset(PatientName="nested")]
+    ds.add_new(0x00091001, "OB", b"private" * 100)
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    path = tmp_path / "raw.dcm"
+    ds.save_as(path, enforce_file_format=False)
+    ds = dcmread(path, force=True)
+
+    core = Core(
+        profile=Profile(
+            [
+                RuleSet(
+                    [
+                        Rule(SingleTag("PatientName"), Hash()),
+                        Rule(SingleTag("PatientID"), Keep()),
+                        Rule(PrivateTags(), Remove()),
+                    ]
+                )
+            ]
+        )
+    )
+    deidentified = core.deidentify(ds)
+
+    def is_raw(dataset, tag):
+        return isinstance(dataset.get_item(tag, keep_deferred=True), RawDataElement)
+
+    assert is_raw(deidentified, "PatientID")  # Keep
+    assert is_raw(deidentified, "StudyID")  # no rule
+    assert not is_raw(deidentified, "PatientName")  # hashed
+    assert 0x00091001 not in deidentified
+    # sequence without rule is recursed into
+    assert deidentified.ReferencedImageSequence[0].PatientName != "nested"
+    assert deidentified.PatientID == "1234"
+
+
+def test_deeply_nested_sequences():
+    """Nesting deeper than the recursion limit works, and is processed in-place"""
+    depth = sys.getrecursionlimit() + 100
+    ds = item = quick_dataset(PatientName="top", PatientID="0")
+    for _ in range(depth):
+        nested = quick_dataset(PatientName="nested", PatientID="1")
+        item.ReferencedImageSequence = [nested]
+        item = nested
+    sequence = ds.ReferencedImageSequence
+
+    core = Core(
+        profile=Profile(
+            [
+                RuleSet(
+                    [
+                        Rule(SingleTag("PatientName"), Remove()),
+                        Rule(SingleTag("ReferencedImageSequence"), Keep()),
+                    ]
+                )
+            ]
+        )
+    )
+    deidentified = core.deidentify(ds)
+
+    assert deidentified.ReferencedImageSequence is sequence
+    assert "PatientName" not in item
+    assert item.PatientID == "1"
+
+
 def test_rule_precedence():
     """Rules are applied in order of generality - most specific first. Verify"""
 
@@ -1,6 +1,11 @@
 import pytest
 
-from idiscore.dataset import RequiredDataset, RequiredTagNotFound
+from idiscore.dataset import (
+    OverlayDataset,
+    RequiredDataset,
+    RequiredTagNotFound,
+    RequiredView,
+)
 from tests.factories import quick_dataset
 
 
@@ -23,3 +28,38 @@ def test_required_dataset():
         RequiredDataset(ds).PatientName
     with pytest.raises(RequiredTagNotFound):
         RequiredDataset(ds)["PatientName"]
+
+    # get() still returns defaults, pydicom relies on this
+    assert RequiredDataset(ds).get("PatientName", "default") == "default"
+
+
+def test_overlay_dataset():
+    """Shows replaced values, without ever changing the original"""
+    ds = quick_dataset(PatientID="1", Modality="US")
+    view = OverlayDataset(ds, {"Modality": "CT", "BurnedInAnnotation": "NO"})
+
+    assert view.Modality == "CT"
+    assert view.BurnedInAnnotation == "NO"
+    assert view.PatientID == "1"
+    assert RequiredDataset(view).Modality == "CT"
+
+    view.PatientName = "added"
+    assert view.PatientName == "added"
+    assert ds.Modality == "US"
+    assert "BurnedInAnnotation" not in ds
+    assert "PatientName" not in ds
+
+
+def test_required_view():
+    """Raises specific exception for missing keys, without copying anything"""
+    ds = quick_dataset(PatientID="1", Modality="CT")
+    view = RequiredView(ds)
+
+    assert view.PatientID == "1"
+    assert view["Modality"].value == "CT"
+    assert "PatientID" in view
+    assert view.get("PatientName", "default") == "default"
+    with pytest.raises(RequiredTagNotFound):
+        view.PatientName
+    with pytest.raises(RequiredTagNotFound):
+        view["PatientName"]
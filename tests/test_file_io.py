@@ -0,0 +1,180 @@
+import os
+
+import pytest
+from pydicom import dcmread
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from idiscore.core import Core, Profile
+from idiscore.file_io import (
+    DeferredLoads,
+    DeferredValueLoaded,
+    PruningReader,
+    can_splice,
+    copy_range,
+    save_as,
+)
+from idiscore.identifiers import PrivateBlockTagIdentifier, PrivateTags, SingleTag
+from idiscore.operators import Clean, Empty, Hash, Keep, Remove
+from idiscore.private_processing import SafePrivateBlock, SafePrivateDefinition
+from idiscore.rules import Rule, RuleSet
+
+
+def test_pruning_reader(a_core_with_some_rules, a_path_to_dataset):
+    """Private and curve elements are dropped while reading, before conversion"""
+    core = a_core_with_some_rules
+    dataset = core.read(a_path_to_dataset)
+
+    # private and curve elements are gone, private creators are not
+    assert 0x50103000 not in dataset
+    assert 0x00B11001 not in dataset
+    assert 0x10130001 not in dataset
+    assert 0x00B10010 in dataset
+    assert isinstance(dataset.get_item(0x00100010), RawDataElement)  # untouched
+
+    # result is the same as reading everything
+    pruned = core.deidentify(dataset)
+    full = core.deidentify(dcmread(a_path_to_dataset))
+    assert list(pruned.keys()) == list(full.keys())
+    assert pruned.PatientName == full.PatientName
+
+
+def test_pruning_reader_decisions(a_path_to_dataset):
+    """Decisions are re-made when rules change"""
+    keep = Rule(PrivateBlockTagIdentifier("00b1,[TestCreator]01"), Keep())
+    rules = RuleSet([Rule(PrivateTags(), Remove()), keep])
+    reader = PruningReader()
+    assert 0x00B11001 in reader.read(a_path_to_dataset, rules)
+    assert 0x10130001 not in reader.read(a_path_to_dataset, rules)
+
+    rules.remove(keep)
+    assert 0x00B11001 not in reader.read(a_path_to_dataset, rules)
+
+
+@pytest.mark.parametrize(
+    "transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+)
+def test_save_as_spliced(a_dataset, tmp_path, transfer_syntax):
+    """Unchanged elements are copied, not loaded and encoded again"""
+    a_dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    a_dataset.add_new("PixelData", "OB", bytes(range(256)) * 64)
+    source = tmp_path / "source.dcm"
+    a_dataset.save_as(source, enforce_file_format=True)
+
+    core = Core(
+        profile=Profile([RuleSet([Rule(SingleTag("PatientName"), Hash())])]),
+        reader=PruningReader(defer_size=1024),
+    )
+    dataset = core.deidentify(core.read(source))
+    dataset.PatientID = "new"
+    del dataset.Modality
+    core.write(dataset, tmp_path / "spliced.dcm", source)
+    assert dataset.get_item("PixelData", keep_deferred=True).value is None
+
+    core.write(dataset, tmp_path / "encoded.dcm")  # no source, just encode
+    spliced = dcmread(tmp_path / "spliced.dcm")
+    assert spliced == dcmread(tmp_path / "encoded.dcm")
+    assert spliced.PixelData == a_dataset.PixelData
+    assert spliced.PatientID == "new"
+    assert "Modality" not in spliced
+
+
+def test_save_as_changed_encoding(a_path_to_dataset, tmp_path):
+    """If encoding has changed since reading, nothing can be copied"""
+    dataset = dcmread(a_path_to_dataset)
+    assert can_splice(dataset, a_path_to_dataset)
+    dataset.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    assert not can_splice(dataset, a_path_to_dataset)
+
+    save_as(dataset, tmp_path / "out.dcm", a_path_to_dataset)
+    assert dcmread(tmp_path / "out.dcm").PatientName == "Martha"
+
+
+def test_save_as_minimal_file_meta(a_dataset, tmp_path):
+    """File meta without media storage UIDs is written as pydicom writes it"""
+    a_dataset.file_meta = FileMetaDataset()
+    a_dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    a_dataset.save_as(tmp_path / "source.dcm")
+    dataset = dcmread(tmp_path / "source.dcm", force=True)
+    meta_before = list(dataset.file_meta.keys())
+
+    save_as(dataset, tmp_path / "spliced.dcm", tmp_path / "source.dcm")
+    dataset.save_as(tmp_path / "encoded.dcm")
+    spliced = (tmp_path / "spliced.dcm").read_bytes()
+    assert spliced == (tmp_path / "encoded.dcm").read_bytes()
+    assert list(dataset.file_meta.keys()) == meta_before
+
+
+def test_save_as_truncated_source(a_dataset, tmp_path):
+    """If source turns out to be too short, dataset is encoded as a whole"""
+    a_dataset.add_new("PixelData", "OB", bytes(4096))
+    a_dataset.save_as(tmp_path / "source.dcm", enforce_file_format=True)
+    dataset = dcmread(tmp_path / "source.dcm")  # all values read
+    with open(tmp_path / "source.dcm", "r+b") as f:
+        f.truncate(1000)
+
+    save_as(dataset, tmp_path / "out.dcm", tmp_path / "source.dcm")
+    written = dcmread(tmp_path / "out.dcm")
+    assert written.PixelData == bytes(4096)
+    assert written.PatientName == "Martha"
+
+
+def test_copy_range_fallback(tmp_path, monkeypatch):
+    """Copying still works where copy_file_range() and sendfile() do not"""
+
+    def not_supported(*args, **kwargs):
+        raise OSError("Not supported")
+
+    monkeypatch.setattr(os, "copy_file_range", not_supported)
+    monkeypatch.setattr(os, "sendfile", not_supported)
+    (tmp_path / "in").write_bytes(b"0123456789")
+    with open(tmp_path / "in", "rb") as source, open(tmp_path / "out", "wb") as out:
+        copy_range(source.fileno(), out.fileno(), 2, 5)
+    assert (tmp_path / "out").read_bytes() == b"23456"
+
+
+@pytest.mark.filterwarnings("ignore:Not removing private creator")
+@pytest.mark.parametrize(
+    "transfer_syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+)
+def test_no_deferred_loads(a_dataset, tmp_path, transfer_syntax):
+    """Large values that are kept, unmatched, emptied or removed are never loaded"""
+    a_dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    a_dataset.add_new("PixelData", "OB", bytes(4096))
+    a_dataset.add_new(0x60003000, "OB", bytes(4096))  # overlay data
+    a_dataset.add_new(0x60023000, "OB", bytes(4096))  # overlay data, emptied
+    block = a_dataset.private_block(0x00B1, "TestCreator")
+    block.add_new(0x02, "OB", bytes(4096))  # safe
+    block.add_new(0x03, "OB", bytes(4096))  # not safe
+    source = tmp_path / "source.dcm"
+    a_dataset.save_as(source, enforce_file_format=True)
+
+    safe_private = SafePrivateDefinition([SafePrivateBlock(["00b1,[TestCreator]02"])])
+    rules = [
+        Rule(SingleTag("PatientName"), Hash()),
+        Rule(SingleTag("PixelData"), Keep()),
+        Rule(SingleTag(0x60023000), Empty()),
+        Rule(PrivateTags(), Clean(safe_private=safe_private)),
+    ]
+    core = Core(Profile([RuleSet(rules)]), reader=PruningReader(defer_size=1024))
+    with DeferredLoads() as loads:
+        core.write(core.deidentify(core.read(source)), tmp_path / "out.dcm", source)
+    loads.assert_none()
+
+    written = dcmread(tmp_path / "out.dcm")
+    assert written.PatientName != "Martha"
+    assert {0x7FE00010, 0x60003000, 0x00B11002} < set(written.keys())
+    assert 0x00B11003 not in written
+    assert not written[0x60023000].value
+
+
+def test_deferred_loads(a_path_to_dataset):
+    """Loading a deferred value is noticed"""
+    with DeferredLoads() as loads:
+        dataset = dcmread(a_path_to_dataset, defer_size=4)
+        assert dataset.PatientName == "Martha"
+
+    assert loads.tags == [0x00100010]
+    with pytest.raises(DeferredValueLoaded):
+        loads.assert_none()
@@ -1,12 +1,14 @@
+import tracemalloc
 from copy import copy
 
 import pytest
 from dicomgenerator.templates import CTDatasetFactory
 from numpy.core.multiarray import ndarray
-from pydicom.dataset import Dataset
-from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, JPEGBaseline8Bit
 
 from idiscore.image_processing import (
+    NativePixelLayout,
     PIILocation,
     PIILocationList,
     PixelProcessor,
@@ -60,3 +62,91 @@ def test_basic_image_processing(a_dataset_with_transfer_syntax):
     # outside the blocks
     assert not is_different(before, after, 21, 1)
     assert not is_different(before, after, 20, 10)
+
+
+def rgb_dataset(planar_configuration: int, frames: int = 1) -> Dataset:
+    """Uncompressed 8-bit RGB, all pixel values 255"""
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.Rows, dataset.Columns = 8, 10
+    dataset.SamplesPerPixel = 3
+    dataset.PhotometricInterpretation = "RGB"
+    dataset.PlanarConfiguration = planar_configuration
+    dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 8, 8, 7
+    dataset.PixelRepresentation = 0
+    if frames > 1:
+        dataset.NumberOfFrames = frames
+    dataset.add_new("PixelData", "OB", b"\xff" * (frames * 8 * 10 * 3))
+    return dataset
+
+
+@pytest.mark.parametrize("planar_configuration", [0, 1])
+def test_clean_in_place(a_dataset_with_transfer_syntax, planar_configuration):
+    """Cleaning raw bytes gives the same pixels as decoding and setting to 0"""
+    areas = [SquareArea(5, 2, 4, 3), SquareArea(0, 0, 2, 1)]
+    for dataset in [a_dataset_with_transfer_syntax, rgb_dataset(planar_configuration)]:
+        assert NativePixelLayout.of(dataset)
+        expected = dataset.pixel_array.copy()
+        expected[2:5, 5:9] = 0
+        expected[0:1, 0:2] = 0
+        PixelProcessor.clean_in_place(dataset, areas)
+        assert (dataset.pixel_array == expected).all()
+
+
+@pytest.mark.parametrize(
+    "clean", [PixelProcessor.clean_in_place, PixelProcessor.clean_decoded]
+)
+@pytest.mark.parametrize("planar_configuration", [0, 1])
+def test_clean_multi_frame(clean, planar_configuration):
+    """Areas are cleaned in all frames and samples, or only in the frames given"""
+    dataset = rgb_dataset(planar_configuration=planar_configuration, frames=3)
+    clean(
+        dataset, [SquareArea(1, 2, 3, 4), SquareArea(0, 0, 10, 1, frames=range(1, 2))]
+    )
+    pixels = dataset.pixel_array
+    assert pixels.shape == (3, 8, 10, 3)
+    assert not pixels[:, 2:6, 1:4, :].any()  # all frames and samples
+    assert not pixels[1, 0, :, :].any()
+    assert pixels[0, 0, :, :].all() and pixels[2, 0, :, :].all()
+    assert pixels.sum() == 255 * (3 * 8 * 10 * 3 - 3 * 4 * 3 * 3 - 10 * 3)
+
+
+def test_clean_in_place_memory():
+    """Peak memory is twice the size of PixelData, counting the original"""
+    tracemalloc.start()
+    try:
+        dataset = rgb_dataset(planar_configuration=0, frames=20000)
+        size = len(dataset.PixelData)
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        PixelProcessor.clean_in_place(dataset, [SquareArea(1, 2, 3, 4)])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak - before < 1.1 * size  # decoding would need another two
+
+
+def test_native_pixel_layout(a_dataset_with_transfer_syntax):
+    """Anything else than uncompressed little endian is decoded"""
+    dataset = a_dataset_with_transfer_syntax
+    assert NativePixelLayout.of(dataset).size == 25 * 34 * 2
+    dataset.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
+    assert NativePixelLayout.of(dataset) is None
+
+
+def test_layout_determined_once(a_dataset_with_transfer_syntax, monkeypatch):
+    """clean_pixel_data() passes the layout it found on to clean_in_place()"""
+    calls = []
+    layout_of = NativePixelLayout.of
+
+    def counting_of(dataset):
+        calls.append(dataset)
+        return layout_of(dataset)
+
+    monkeypatch.setattr(NativePixelLayout, "of", counting_of)
+    location = PIILocation(areas=[SquareArea(0, 0, 20, 3)])
+    PixelProcessor(PIILocationList([location])).clean_pixel_data(
+        a_dataset_with_transfer_syntax
+    )
+    assert len(calls) == 1
@@ -7,7 +7,17 @@ from dicomgenerator.generators import DataElementFactory
 from factory import random
 from pydicom.dataset import Dataset
 
-from idiscore.operators import Clean, Hash, HashUID, SetFixedValue, TimeDeltaProvider
+from idiscore.operators import (
+    Clean,
+    Empty,
+    Hash,
+    HashUID,
+    REMOVE,
+    Keep,
+    Remove,
+    SetFixedValue,
+    TimeDeltaProvider,
+)
 
 
 @pytest.fixture
@@ -30,6 +40,34 @@ def test_operations():
     operation.apply(element)
 
 
+def test_unchanged_and_in_place():
+    """Operators can signal 'unchanged' by returning the element itself"""
+    element = DataElementFactory(tag="PatientName", value="Patient^Name")
+    assert Keep().apply(element) is element
+
+    # Empty copies by default, but can also empty the element itself
+    emptied = Empty().apply(element)
+    assert emptied is not element
+    assert emptied.value is None
+    assert element.value == "Patient^Name"
+
+    assert Empty().apply_in_place(element) is element
+    assert element.value is None
+
+    # operators without in-place implementation fall back to apply()
+    hashed = Hash().apply_in_place(element)
+    assert hashed is not element
+
+
+def test_remove():
+    """Removal is signalled by returning REMOVE, not by raising"""
+    assert Remove().apply(DataElementFactory(tag="PatientName")) is REMOVE
+
+    # private elements are removed by clean unless marked safe
+    private = DataElementFactory(tag=0x00B11001, VR="LO")
+    assert Clean().apply(private, Dataset()) is REMOVE
+
+
 def test_clean():
     """Tricky operation, this clean. Test some cases"""
     clean = Clean()
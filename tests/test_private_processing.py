@@ -1,10 +1,19 @@
+import json
+import pickle
+
 import pytest
 from dicomgenerator.templates import CTDatasetFactory
 from pydicom.dataset import Dataset
 
 from idiscore.identifiers import TagIdentifier
+from idiscore.exceptions import SafePrivateError
 from idiscore.image_processing import CriterionException
-from idiscore.private_processing import SafePrivateBlock, SafePrivateDefinition
+from idiscore.private_processing import (
+    PrivateBlockIndex,
+    SafePrivateBlock,
+    SafePrivateDefinition,
+    StringCriterion,
+)
 
 
 def test_private_definition(a_ct_safe_private_definition):
@@ -82,3 +91,160 @@ def test_private_definition_strings():
 
     # for a US dataset only the last block is considered safe
     assert len(definition.safe_identifiers(CTDatasetFactory(Modality="US"))) == 2
+
+
+class CountingCriterion:
+    """Criterion that remembers how often it was called"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, dataset):
+        self.calls += 1
+        return dataset.Modality == "CT"
+
+
+def a_private_dataset(**kwargs) -> Dataset:
+    dataset = CTDatasetFactory(**kwargs)
+    block = dataset.private_block(0x00B1, "TestCreator", create=True)
+    block.add_new(0x01, "SH", "value1")
+    block.add_new(0x03, "SH", "value2")
+    return dataset
+
+
+@pytest.mark.parametrize("series_level", [False, True])
+def test_safe_private_memoization(some_private_identifiers, series_level):
+    """Block criteria are checked once per dataset, or once per series"""
+    criterion = CountingCriterion()
+    definition = SafePrivateDefinition(
+        blocks=[
+            SafePrivateBlock(
+                tags=some_private_identifiers,
+                criterion=criterion,
+                series_level=series_level,
+            )
+        ]
+    )
+    dataset = a_private_dataset()
+    assert definition.is_safe(dataset[0x00B11001], dataset)
+    assert not definition.is_safe(dataset[0x00B11003], dataset)
+    assert criterion.calls == 1
+
+    same_series = a_private_dataset(SeriesInstanceUID=dataset.SeriesInstanceUID)
+    assert definition.is_safe(same_series[0x00B11001], same_series)
+    assert criterion.calls == (1 if series_level else 2)
+
+    other_series = a_private_dataset(Modality="US")
+    assert not definition.is_safe(other_series[0x00B11001], other_series)
+    assert criterion.calls == (2 if series_level else 3)
+
+    # results can be forgotten, and are not pickled
+    definition.clear_cache()
+    assert definition.is_safe(dataset[0x00B11001], dataset)
+    assert criterion.calls == (3 if series_level else 4)
+
+    unpickled = pickle.loads(pickle.dumps(definition))
+    assert unpickled.is_safe(dataset[0x00B11001], dataset)
+    assert unpickled.blocks[0].criterion.calls == criterion.calls + 1
+
+
+def test_only_relevant_blocks_are_checked(some_private_identifiers):
+    """Criteria of blocks for private creators not in the dataset are not checked"""
+    relevant, irrelevant = CountingCriterion(), CountingCriterion()
+    definition = SafePrivateDefinition(
+        blocks=[
+            SafePrivateBlock(tags=["00b1[othercreator]01"], criterion=irrelevant),
+            SafePrivateBlock(tags=some_private_identifiers, criterion=relevant),
+        ]
+    )
+    dataset = a_private_dataset()
+    assert definition.is_safe(dataset[0x00B11001], dataset)
+    assert (relevant.calls, irrelevant.calls) == (1, 0)
+
+
+def test_string_criterion():
+    """Criteria can be given as dicomcriterion strings, parsed only once"""
+    block = SafePrivateBlock(tags=[], criterion="Modality.equals('CT')")
+    assert block.tags_are_safe(CTDatasetFactory())
+    assert not block.tags_are_safe(CTDatasetFactory(Modality="US"))
+
+    other = StringCriterion(" Modality.equals('CT')")
+    assert other.criterion is block.criterion.criterion
+
+
+@pytest.fixture
+def a_catalogue():
+    return [
+        {
+            "tags": ["00b1,[TestCreator]01", "00b1,[TestCreator]02"],
+            "criterion": "Modality.equals('CT')",
+            "comment": "Only safe for CT",
+            "series_level": True,
+        },
+        {"tags": ["00b1,[TestCreator]03"], "comment": "Always safe"},
+    ]
+
+
+def test_safe_private_from_json(a_catalogue, tmp_path):
+    path = tmp_path / "catalogue.json"
+    path.write_text(json.dumps(a_catalogue))
+    definition = SafePrivateDefinition.from_json(path)
+
+    assert [len(x.tags) for x in definition.blocks] == [2, 1]
+    assert definition.blocks[0].series_level
+    ct, us = a_private_dataset(), a_private_dataset(Modality="US")
+    assert definition.is_safe(ct[0x00B11001], ct)
+    assert not definition.is_safe(us[0x00B11001], us)
+    assert definition.is_safe(us[0x00B11003], us)
+
+    path.write_text(json.dumps([{"tags": ["not a tag"]}]))
+    with pytest.raises(SafePrivateError):
+        SafePrivateDefinition.from_json(path)
+
+
+def test_safe_private_from_csv(tmp_path):
+    """Tags with the same criterion, comment and series level form one block"""
+    path = tmp_path / "catalogue.csv"
+    path.write_text(
+        "tag,criterion,comment,series_level\n"
+        "\"00b1,[TestCreator]01\",Modality.equals('CT'),Only safe for CT,true\n"
+        '"00b1,[TestCreator]03",,Always safe,\n'
+        "\"00b1,[TestCreator]02\",Modality.equals('CT'),Only safe for CT,true\n"
+    )
+    definition = SafePrivateDefinition.from_csv(path)
+
+    assert [len(x.tags) for x in definition.blocks] == [2, 1]
+    assert definition.blocks[0].series_level
+    assert definition.blocks[1].criterion is None
+    us = a_private_dataset(Modality="US")
+    assert not definition.is_safe(us[0x00B11001], us)
+    assert definition.is_safe(us[0x00B11003], us)
+
+    path.write_text('tag,criterion\n"00b1,[TestCreator]01",Modality.equals(\n')
+    with pytest.raises(SafePrivateError):
+        SafePrivateDefinition.from_csv(path)
+
+
+def test_private_block_index():
+    """Private creators and their elements are found in a single pass"""
+    dataset = Dataset()
+    dataset.PatientName = "Name"
+    first = dataset.private_block(0x00B1, "first", create=True)
+    first.add_new(0x01, "SH", "value1")
+    first.add_new(0xFF, "SH", "value2")
+    dataset.private_block(0x00B1, "second", create=True)  # (00b1,0011)
+    dataset.private_block(0x00B3, "empty", create=True)
+
+    index = PrivateBlockIndex(dataset)
+
+    assert index.creators == {
+        (0x00B1, 0x10): "first",
+        (0x00B1, 0x11): "second",
+        (0x00B3, 0x10): "empty",
+    }
+    assert index.creator(0x00B110FF) == "first"
+    assert index.creator(0x00B11101) == "second"
+    assert index.creator(0x00B11201) is None
+    assert index.elements_in_block(0x00B10010) == [0x00B11001, 0x00B110FF]
+    assert index.elements_in_block(0x00B10011) == []
+    assert index.elements_in_block(0x00B30010) == []
@@ -6,11 +6,17 @@ from dicomgenerator.generators import (
     DataElementFactory as DatEF,
 )
 from dicomgenerator.templates import CTDatasetFactory
+from pydicom.dataset import Dataset
 
 from idiscore.bouncers import RejectKOGSPS
 from idiscore.core import Core, Profile
 from idiscore.dicom import ActionCodes
-from idiscore.identifiers import PrivateTags, RepeatingGroup, SingleTag
+from idiscore.identifiers import (
+    PrivateBlockTagIdentifier,
+    PrivateTags,
+    RepeatingGroup,
+    SingleTag,
+)
 from idiscore.operators import Clean, Hash, Remove
 from idiscore.rule_sets import DICOMRuleSets
 from idiscore.rules import Rule, RuleSet
@@ -83,6 +89,56 @@ def test_rule_set():
     )  # try a private tag rule
 
 
+def test_rule_set_wildcard_order():
+    """Wildcard rules are indexed per group, but specific-to-general order must
+    hold across all of them
+    """
+    ds = Dataset()
+    block = ds.private_block(0x0011, "creator", create=True)
+    block.add_new(0x01, "SH", "value")
+    block.add_new(0x02, "SH", "value")
+
+    rule_block = Rule(PrivateBlockTagIdentifier("0011[creator]01"), Hash())
+    rule_group = Rule(RepeatingGroup("0011,1xxx"), Remove())
+    rule_private = Rule(PrivateTags(), Remove())
+    rule_element = Rule(RepeatingGroup("xxxx,0010"), Hash())  # no fixed group
+    rule_curve = Rule(RepeatingGroup("50xx,xxxx"), Remove())
+    rules = RuleSet(rules=[rule_private, rule_group, rule_block, rule_element])
+
+    assert rules.get_rule(block[0x01]) == rule_block
+    assert rules.get_rule(block[0x02]) == rule_group
+    assert rules.get_rule(ds[0x00110010]) == rule_element
+    assert rules.get_rule(DatEF(tag=(0x0013, 0x1001))) == rule_private
+    assert rules.get_rule(DatEF(tag=(0x5000, 0x0010))) == rule_element
+
+    rules = RuleSet(rules=[rule_private, rule_curve, rule_element])
+    assert rules.get_rule(DatEF(tag=(0x5000, 0x0010))) == rule_element
+
+    # private block rules are only matched with a known private creator
+    assert rules.get_rule(DatEF(tag=(0x0011, 0x1001))) == rule_private
+    rules = RuleSet(rules=[rule_block])
+    assert rules.get_rule(DatEF(tag=(0x0011, 0x1001))) is None
+    assert rules.get_rule(block[0x01]) == rule_block
+
+
+def test_removes_unconditionally():
+    """Which tags can be dropped without looking at element or dataset?"""
+    rules = RuleSet(
+        [
+            Rule(PrivateTags(), Remove()),
+            Rule(RepeatingGroup("50xx,xxxx"), Remove()),
+            Rule(PrivateBlockTagIdentifier("0011,[creator]01"), Hash()),
+            Rule(SingleTag("PatientName"), Hash()),
+        ]
+    )
+    assert rules.removes_unconditionally(0x50103000)
+    assert rules.removes_unconditionally(0x00111002)
+    assert not rules.removes_unconditionally(0x00111001)  # keep for some creators
+    assert not rules.removes_unconditionally(0x00110010)  # private creator
+    assert not rules.removes_unconditionally(0x00100010)
+    assert not rules.removes_unconditionally(0x00100020)  # no rule
+
+
 def test_rule_set_remove():
 
     # some rules
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from pydicom.uid import (
+    CTImageStorage,
+    EncapsulatedPDFStorage,
+    GrayscaleSoftcopyPresentationStateStorage,
+    KeyObjectSelectionDocumentStorage,
+)
+
+from idiscore.bouncers import (
+    Bouncer,
+    BouncerError,
+    CriterionBouncer,
+    DatasetRejected,
+    RejectEncapsulatedImageStorage,
+    RejectKOGSPS,
+    RejectNonStandardDicom,
+)
+from idiscore.triage import HeaderTable, triage, triage_keywords
+from tests.factories import quick_dataset
+
+
+@pytest.fixture
+def some_datasets():
+    """Datasets that different bouncers stop for different reasons"""
+    return [
+        quick_dataset(SOPClassUID=CTImageStorage, Modality="CT"),
+        quick_dataset(SOPClassUID=CTImageStorage, Modality="MR"),
+        quick_dataset(SOPClassUID="1.2.3", Modality="US", BurnedInAnnotation="YES"),
+        quick_dataset(SOPClassUID=EncapsulatedPDFStorage, Modality="DOC"),
+        quick_dataset(SOPClassUID=KeyObjectSelectionDocumentStorage),
+        quick_dataset(
+            SOPClassUID=GrayscaleSoftcopyPresentationStateStorage,
+            SeriesDescription="Annotation",
+        ),
+        quick_dataset(SOPClassUID=GrayscaleSoftcopyPresentationStateStorage),
+        quick_dataset(Modality="CT"),
+    ]
+
+
+def test_triage(some_datasets):
+    """Same answers as running each bouncer on each dataset"""
+    bouncers = [
+        RejectNonStandardDicom(),
+        RejectEncapsulatedImageStorage(),
+        RejectKOGSPS(),
+        CriterionBouncer("Modality.equals('mr') or Modality.equals('DOC')"),
+        CriterionBouncer("Modality.equals('US') and BurnedInAnnotation.equals('YES')"),
+    ]
+    keywords = triage_keywords(bouncers)
+    assert keywords == [
+        "SOPClassUID",
+        "SeriesDescription",
+        "Modality",
+        "BurnedInAnnotation",
+    ]
+    result = triage(bouncers, HeaderTable.from_datasets(some_datasets, keywords))
+
+    for index, bouncer in enumerate(bouncers):
+        for row, dataset in enumerate(some_datasets):
+            try:
+                bouncer.inspect(dataset)
+                expected = (False, False)
+            except DatasetRejected:
+                expected = (True, False)
+            except BouncerError:
+                expected = (False, True)
+            assert (result.rejected[index, row], result.errors[index, row]) == (
+                expected
+            )
+
+    assert result.counts()[bouncers[3]] == 2
+    assert list(result.stopped_by()) == [-1, 3, 0, 1, 2, -1, 2, 0]
+    assert list(np.flatnonzero(result.accepted)) == [0, 5]
+
+
+def test_triage_from_paths(a_dataset, tmp_path):
+    a_dataset.SOPClassUID = EncapsulatedPDFStorage
+    a_dataset.save_as(tmp_path / "1.dcm", enforce_file_format=True)
+    a_dataset.SOPClassUID = CTImageStorage
+    a_dataset.save_as(tmp_path / "2.dcm", enforce_file_format=True)
+
+    bouncers = [RejectEncapsulatedImageStorage()]
+    paths = [tmp_path / "1.dcm", tmp_path / "2.dcm", tmp_path / "2.dcm"]
+    table = HeaderTable.from_paths(paths, triage_keywords(bouncers))
+    assert len(table["SOPClassUID"].values) == 2  # distinct values only
+    assert list(triage(bouncers, table).rejected[0]) == [True, False, False]
+
+
+def test_triage_unreadable(a_dataset, tmp_path):
+    """Files that cannot be read are errors for each bouncer. Others are triaged"""
+    a_dataset.SOPClassUID = EncapsulatedPDFStorage
+    a_dataset.save_as(tmp_path / "1.dcm", enforce_file_format=True)
+    (tmp_path / "not_dicom.txt").write_text("not a DICOM file")
+
+    bouncers = [
+        RejectEncapsulatedImageStorage(),
+        CriterionBouncer("Modality.equals('CT')"),
+    ]
+    paths = [tmp_path / "1.dcm", tmp_path / "not_dicom.txt", tmp_path / "missing.dcm"]
+    table = HeaderTable.from_paths(paths, triage_keywords(bouncers))
+    assert list(table.unreadable) == [False, True, True]
+
+    result = triage(bouncers, table)
+    assert list(result.rejected[0]) == [True, False, False]
+    assert result.errors[:, 1:].all()
+    assert list(result.stopped_by()) == [0, 0, 0]
+    assert not result.accepted.any()
+
+
+def test_triage_unknown_tags(some_datasets):
+    """Bouncers that do not say which elements they inspect cannot be triaged"""
+
+    class Unknown(Bouncer):
+        def inspect(self, dataset):
+            pass
+
+    with pytest.raises(ValueError):
+        triage_keywords([Unknown()])
+    with pytest.raises(ValueError):
+        triage([Unknown()], HeaderTable.from_datasets(some_datasets, []))
+
+
+def test_triage_no_bouncers(some_datasets):
+    """Without bouncers, everything is accepted"""
+    result = triage([], HeaderTable.from_datasets(some_datasets, []))
+    assert list(result.stopped_by()) == [-1] * len(some_datasets)
+    assert result.accepted.all()
+    assert result.counts() == {}
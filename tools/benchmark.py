@@ -0,0 +1,136 @@
+"""Time deidentification of synthetic datasets, for comparing performance between
+code changes.
+
+Usage::
+
+    $python tools/benchmark.py
+
+Prints the time per dataset for each benchmark, and the time per inspection for
+bouncers. Numbers only mean something relative to other runs on the same machine.
+"""
+import time
+import timeit
+from typing import Callable, List
+
+from dicomgenerator.generators import quick_dataset
+from pydicom.dataset import Dataset
+from pydicom.uid import CTImageStorage
+
+from idiscore.bouncers import (
+    Bouncer,
+    RejectEncapsulatedImageStorage,
+    RejectKOGSPS,
+    RejectNonStandardDicom,
+)
+from idiscore.core import Core
+from idiscore.dataset import RequiredDataset, RequiredView
+from idiscore.defaults import create_default_core
+
+
+def nested_dataset(depth: int, width: int) -> Dataset:
+    """Dataset with sequences nested depth levels deep, each with width items.
+
+    Resembles the content tree of a structured report. Total number of items is
+    width * depth, only the first item at each level contains the next level
+    """
+    dataset = item = quick_dataset(PatientName="Patient^Top", PatientID="1234")
+    for level in range(depth):
+        items = [
+            quick_dataset(
+                PatientName=f"Patient^Level{level}",
+                ReferencedSOPInstanceUID=f"1.2.3.{level}.{x}",
+                CodeMeaning="Some finding",
+            )
+            for x in range(width)
+        ]
+        item.ContentSequence = items
+        item = items[0]
+    return dataset
+
+
+def wide_dataset(n_items: int) -> Dataset:
+    """Dataset with a single sequence of n_items items. Resembles the contour
+    sequences of an RT structure set
+    """
+    dataset = quick_dataset(PatientName="Patient^Top", PatientID="1234")
+    dataset.ContentSequence = [
+        quick_dataset(
+            ReferencedSOPInstanceUID=f"1.2.3.{x}",
+            PatientName="Patient^Item",
+            CodeMeaning="Contour",
+        )
+        for x in range(n_items)
+    ]
+    return dataset
+
+
+def private_dataset(n_creators: int, n_elements: int) -> Dataset:
+    """Dataset with n_creators private blocks of n_elements elements each, spread
+    out over several groups. Resembles vendor-heavy MR and CT headers
+    """
+    dataset = quick_dataset(PatientName="Patient^Top", PatientID="1234")
+    for creator in range(n_creators):
+        group = 0x0019 + 2 * (creator % 8)
+        block = dataset.private_block(group, f"VENDOR {creator}", create=True)
+        for offset in range(n_elements):
+            block.add_new(offset, "LO", f"value {offset}")
+    return dataset
+
+
+def time_deidentify(
+    core: Core, create_dataset: Callable[[], Dataset], repeats: int = 5
+) -> float:
+    """Best time in seconds of deidentifying a freshly created dataset"""
+    timings: List[float] = []
+    for _ in range(repeats):
+        dataset = create_dataset()  # not copied, deepcopy is recursive
+        start = time.perf_counter()
+        core.deidentify(dataset)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def time_per_call(function: Callable[[], object], number: int = 20000) -> float:
+    """Best time in seconds of a single call to function"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def time_bouncers():
+    """Time per inspection of each built-in bouncer, and of wrapping a dataset to
+    catch missing keys
+    """
+    dataset = private_dataset(40, 50)  # wrapping cost might depend on size
+    dataset.SOPClassUID = CTImageStorage
+    dataset.SeriesDescription = "Series"
+    bouncers: List[Bouncer] = [
+        RejectNonStandardDicom(),
+        RejectKOGSPS(),
+        RejectEncapsulatedImageStorage(),
+    ]
+    timings = {
+        "RequiredDataset(dataset)": lambda: RequiredDataset(dataset).SOPClassUID,
+        "RequiredView(dataset)": lambda: RequiredView(dataset).SOPClassUID,
+    }
+    for bouncer in bouncers:
+        timings[type(bouncer).__name__] = lambda x=bouncer: x.inspect(dataset)
+    for name, function in timings.items():
+        print(f"{name:<30} {time_per_call(function) * 1e6:10.2f} us")
+
+
+def run_benchmarks():
+    core = create_default_core()
+    core.bouncers = []  # synthetic datasets are not complete enough for bouncers
+    benchmarks = {
+        "nested, depth 100, width 10": lambda: nested_dataset(depth=100, width=10),
+        "nested, depth 2000, width 2": lambda: nested_dataset(depth=2000, width=2),
+        "wide, 20000 items": lambda: wide_dataset(n_items=20000),
+        "private, 40 blocks of 50": lambda: private_dataset(40, 50),
+    }
+    for name, create_dataset in benchmarks.items():
+        seconds = time_deidentify(core, create_dataset)
+        print(f"{name:<30} {seconds * 1000:10.1f} ms")
+    time_bouncers()
+
+
+if __name__ == "__main__":
+    run_benchmarks()